@@ -1,3 +1,28 @@
+import os
+import sys
+
+# the modules import each other by name, make sure they can find each other
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
 from processing import process_raw_data
 from parse_file import parse
 
+if __name__ == '__main__':
+    # python -m anemia_plotter batch <dir|glob> ...   -> batch.py
+    # python -m anemia_plotter bench ...              -> bench.py
+    # python -m anemia_plotter sweep <file> ...       -> sweep.py
+    # python -m anemia_plotter convert <files> ...    -> dataset.py
+    # python -m anemia_plotter                        -> pick a file & plot it
+    if sys.argv[1:2] == ['batch']:
+        from batch import main
+        sys.exit(main(sys.argv[2:]))
+    if sys.argv[1:2] == ['bench']:
+        from bench import main
+        sys.exit(main(sys.argv[2:]))
+    if sys.argv[1:2] == ['sweep']:
+        from sweep import main
+        sys.exit(main(sys.argv[2:]))
+    if sys.argv[1:2] == ['convert']:
+        from dataset import main
+        sys.exit(main(sys.argv[2:]))
+    process_raw_data()
@@ -0,0 +1,245 @@
+'''
+    Processing a whole directory (or glob) of lvm files unattended.
+
+        python -m anemia_plotter batch <dir|glob> [<dir|glob> ...] [options]
+
+    Every file goes through process_raw_data with the same settings, in a
+    pool of worker processes (one file per worker at a time). The summary
+    of each file is written out as soon as it is done, so a summary file is
+    usable (and tail-able) while the batch is still running:
+        .csv            one row per file
+        .json / .jsonl  one json object per line
+    Files that fail are written out too, with the error.
+    With --figures, the summary graph of every file is written to that
+    directory (headless, see plot.render) by the worker that did the file.
+    With --store, the results (peaks too) go into a store.ResultStore, and
+    files it has with the same settings, unchanged since, are skipped:
+    their summary rows come from the store. With --figures they're only
+    skipped if their figure is there already.
+'''
+import os
+import sys
+import csv
+import json
+import glob
+import time
+import argparse
+import multiprocessing
+
+from processing import process_raw_data
+from cache import fingerprint
+from store import get_store, params, SCORE_COLUMNS
+
+# summary columns, in order.
+FIELDS = ['filename', 'start_time', 'delta_x', 'sampling frequency', 'rows',
+    'number of particles', 'bin size', 'smoothing', 'deg', 'detrend', 'cutoff',
+    'delta', 'max', 'figure', 'events', 'hits', 'misses', 'false positives',
+    'mean offset', 'seconds', 'error']
+
+
+def find_files(patterns, extension='.lvm'):
+    """ turns a list of directories and glob patterns into a sorted list
+        of files. directories give every file in them with extension.
+        """
+    found = set()
+    for p in patterns:
+        if os.path.isdir(p):
+            found.update(os.path.join(p, f) for f in os.listdir(p)
+                if f.lower().endswith(extension))
+        else:
+            found.update(f for f in glob.glob(p) if os.path.isfile(f))
+    return sorted(found)
+
+
+def figure_path(filename, figures, extension='png'):
+    """ the file the summary graph of filename goes to, in figures """
+    return os.path.join(figures, os.path.splitext(
+        os.path.basename(filename))[0] + '.' + extension)
+
+
+def process_file(task):
+    """ runs process_raw_data on one file in a worker.
+        task is (filename, settings). returns a summary row (a dict with
+        the FIELDS). exceptions are caught and go into 'error'.
+        settings can have figures (a directory) & format (png, svg, pdf)
+        to write the summary graph, and peaks: True to also return the 
+        peak table ('particles'), the number of columns ('numcols') &
+        the fingerprint the file had.
+        """
+    filename, settings = task
+    settings = dict(settings)
+    figures, extension = settings.pop('figures', None), \
+        settings.pop('format', 'png')
+    peaks = settings.pop('peaks', False)
+    figure = figure_path(filename, figures, extension) if figures else None
+    row = {'filename': filename, 'error': ''}
+    start = time.time()
+    try:
+        if peaks: # before it's read, in case it's still being written
+            row['fingerprint'] = fingerprint(filename)
+        r = process_raw_data(filename, output=False, show_plot=False,
+            figure=figure, **settings)
+        row.update({k: r[k] for k in FIELDS if k in r})
+        if 'rows' not in r:
+            row['rows'] = len(r['X_Value'])
+        if peaks:
+            row['particles'] = r['particles']
+            row['numcols'] = r['numcols']
+    except Exception as e:
+        row['error'] = '{}: {}'.format(type(e).__name__, e)
+    row['seconds'] = round(time.time() - start, 3)
+    return row
+
+
+def stored_row(filename, run, figure=None):
+    """ the summary row of a run in the store """
+    row = {'filename': filename, 'start_time': run['start_time'],
+        'delta_x': run['delta_x'],
+        'sampling frequency': run['sampling_frequency'], 'rows': run['rows'],
+        'number of particles': run['particles'], 'bin size': run['binsize'],
+        'smoothing': run['smoothing'], 'deg': run['deg'],
+        'detrend': run['detrend'], 'cutoff': run['cutoff'],
+        'delta': run['delta'], 'max': run['maxima'] or None, 'seconds': 0.,
+        'error': ''}
+    if figure is not None:
+        row['figure'] = figure
+    if run['validate']:
+        row.update({k: run[column] for k, column in SCORE_COLUMNS.items()})
+    return row
+
+
+def run_batch(patterns, summary='summary.csv', workers=None, output=True,
+    store=None, force=False, **settings):
+    """ processes every file matched by patterns in a process pool.
+
+        args    -> patterns: list of directories / glob patterns
+                -> summary: file the per file results are written to.
+                    .csv, or .json/.jsonl for json lines.
+                -> workers: number of processes. defaults to the cpu count
+                -> output: print progress
+                -> store: a store.ResultStore (or its path, or True for 
+                    the default one) the results go into. files it has 
+                    already are skipped.
+                -> force: process the files in the store again anyway
+                -> settings: passed to process_raw_data
+                    (delta, binsize, deg, maxima, smoothing, stream, ...)
+                    and figures & format, see process_file
+        returns the list of summary rows, in the order they finished.
+        """
+    files = find_files(patterns)
+    if settings.get('figures') and not os.path.isdir(settings['figures']):
+        os.makedirs(settings['figures'])
+    store = get_store(store)
+    stored = []
+
+    def figure(f):
+        if settings.get('figures'):
+            return figure_path(f, settings['figures'], 
+                settings.get('format', 'png'))
+
+    if store is not None:
+        settings['peaks'] = True
+        if not force: # the store has no figures, those have to be there
+            stored = [f for f in files if store.has(f, settings) and 
+                (figure(f) is None or os.path.isfile(figure(f)))]
+            files = [f for f in files if f not in set(stored)]
+    if output: print('batch: {} files, {} workers{}'.format(len(files),
+        workers or multiprocessing.cpu_count(), ', {} stored already'.format(
+        len(stored)) if stored else ''))
+    as_json = os.path.splitext(summary)[1].lower() in ('.json', '.jsonl')
+    rows = []
+    with open(summary, 'w') as out:
+        if not as_json:
+            writer = csv.DictWriter(out, FIELDS)
+            writer.writeheader()
+
+        def write(row):
+            if as_json:
+                out.write(json.dumps(row) + '\n')
+            else:
+                writer.writerow(row)
+            out.flush() # results are on disk as soon as a file is done
+            rows.append(row)
+
+        for f in stored:
+            write(stored_row(f, store.runs(filename=f, 
+                **params(settings))[-1], figure(f)))
+        pool = multiprocessing.Pool(workers)
+        try:
+            tasks = [(f, settings) for f in files]
+            for row in pool.imap_unordered(process_file, tasks):
+                particles = row.pop('particles', None)
+                current = row.pop('fingerprint', None)
+                numcols = row.pop('numcols', None)
+                if store is not None and not row['error']:
+                    store.add(dict(row, numcols=numcols), settings, 
+                        particles, current)
+                write(row)
+                if output: print('batch: {}/{} {} -> {}'.format(
+                    len(rows) - len(stored), len(files), row['filename'], 
+                    row['error'] or row.get('number of particles')))
+            pool.close()
+        except BaseException:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+    return rows
+
+
+def main(argv=None):
+    """ the command line entry point. returns the exit status """
+    parser = argparse.ArgumentParser(prog='anemia_plotter batch',
+        description='process a directory of lvm files')
+    parser.add_argument('patterns', nargs='+',
+        help='directories or glob patterns of lvm files')
+    parser.add_argument('-o', '--summary', default='summary.csv',
+        help='summary file, .csv or .json (json lines)')
+    parser.add_argument('-j', '--workers', type=int, default=None,
+        help='worker processes. defaults to the number of cpus')
+    parser.add_argument('--delta', type=float, default=.004)
+    parser.add_argument('--binsize', type=int, default=20)
+    parser.add_argument('--deg', type=int, default=3)
+    parser.add_argument('--smoothing', default='binned',
+        choices=['binned', 'centered', 'trailing'])
+    parser.add_argument('--detrend', default='polyfit',
+        choices=['polyfit', 'highpass', 'both'])
+    parser.add_argument('--cutoff', type=float, default=.1,
+        help='Hz, cutoff of the high pass (--detrend highpass/both)')
+    parser.add_argument('--maxima', action='store_true',
+        help='count maxima instead of minima')
+    parser.add_argument('--stream', action='store_true',
+        help='process each file in blocks (bounded memory)')
+    parser.add_argument('--validate', action='store_true',
+        help='check the peaks against the manual particle detector')
+    parser.add_argument('--tolerance', type=float, default=None,
+        help='seconds, see --validate. defaults to a bin of the smoothing')
+    parser.add_argument('--figures', default=None,
+        help='write the summary graph of every file to this directory')
+    parser.add_argument('--format', default='png',
+        choices=['png', 'svg', 'pdf'], help='of the --figures')
+    parser.add_argument('--store', nargs='?', const=True, default=None,
+        help='keep the results in this sqlite database (by default '
+        '~/.anemia_plotter/results.sqlite) and skip the files in it already')
+    parser.add_argument('--force', action='store_true',
+        help='with --store, process the files in it again anyway')
+    parser.add_argument('-q', '--quiet', action='store_true')
+    args = parser.parse_args(argv)
+    if args.stream and args.validate:
+        parser.error('--validate can not be used with --stream')
+    if args.stream and args.figures:
+        parser.error('--figures can not be used with --stream')
+
+    rows = run_batch(args.patterns, summary=args.summary,
+        workers=args.workers, output=not args.quiet, delta=args.delta,
+        binsize=args.binsize, deg=args.deg, smoothing=args.smoothing,
+        detrend=args.detrend, cutoff=args.cutoff,
+        maxima=args.maxima or None, stream=args.stream,
+        validate=args.validate, tolerance=args.tolerance,
+        figures=args.figures, format=args.format, store=args.store,
+        force=args.force)
+    return 1 if any(r['error'] for r in rows) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,272 @@
+'''
+    Benchmarks for the processing pipeline, on synthetic lvm files.
+
+        python -m anemia_plotter bench [--rows N] [--channels C] ...
+
+    write_lvm makes a file that looks like what acquisition.vi writes: the
+    24 line header, tab seperated X_Value/Voltage_N columns and a sparse
+    comment column with the manual particle detector flag. The output
+    channel (Voltage_1) has slow drift, noise and short dips where particles
+    pass.
+
+    run_benchmarks times parse, moving_average, polyfit, find_peaks and
+    process_raw_data (plain & streaming) on it and reports rows/s and the
+    peak memory each one allocated. Results can be saved as a baseline and
+    later runs compared against it to catch regressions.
+'''
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+
+import numpy as np
+
+from parse_file import parse
+from calc import moving_average, polyfit, find_peaks
+from processing import process_raw_data
+
+try:
+    import tracemalloc # numpy reports its allocations to it
+except ImportError: # python 2
+    tracemalloc = None
+
+HEADER = '''LabVIEW Measurement\t
+Writer_Version\t2
+Reader_Version\t2
+Separator\tTab
+Decimal_Separator\t.
+Multi_Headings\tNo
+X_Columns\tOne
+Time_Pref\tAbsolute
+Operator\tbench
+Description\tsynthetic data
+Date\t{date}
+Time\t{time}
+***End_of_Header***\t
+\t
+Channels\t{channels}\t
+Samples\t{per_channel}
+Date\t{per_channel_date}
+Time\t{per_channel_time}
+Y_Unit_Label\t{units}
+X_Dimension\t{dimensions}
+X0\t{x0}
+Delta_X\t{delta_x}
+***End_of_Header***\t
+{titles}
+'''
+WRITE_ROWS = 100000 # rows formatted at a time
+DEFAULT_BASELINE = os.path.join(os.path.expanduser('~'), '.anemia_plotter',
+    'bench_baseline.json')
+
+
+def write_lvm(path, rows=10**6, channels=2, spike_rate=2., comment_rate=.002,
+    delta_x=1e-4, drift=.02, noise=.001, spike_depth=.02, spike_width=200,
+    seed=0, start_time='14:22:13.84381103515625'):
+    """ Writes a synthetic lvm file, like acquisition.vi's.
+
+        args    -> rows: number of data rows
+                -> channels: number of Voltage_N columns (at least 2.
+                    Voltage_0 is the input, Voltage_1 the output)
+                -> spike_rate: particles per second on the output
+                -> comment_rate: fraction of rows with a comment
+                -> delta_x: seconds between rows
+                -> drift: size of the slow drift of the output
+                -> noise: std of the gaussian noise on every channel
+                -> spike_depth, spike_width: size (volts) and length (rows)
+                    of the dips particles make in the output
+                -> seed: for the random numbers
+        returns the sample positions of the particles
+        """
+    if channels < 2:
+        raise ValueError('acquisition files have at least 2 channels')
+    random = np.random.RandomState(seed)
+    duration = rows * delta_x
+    spikes = np.sort(random.randint(0, rows,
+        random.poisson(spike_rate * duration) if rows else 0))
+    # a few of the particles were also marked by hand
+    marked = set(spikes[random.rand(len(spikes)) < .5].tolist())
+    dip = spike_depth * np.hanning(spike_width + 2)[1:-1]
+
+    repeated = lambda s: '\t'.join([s] * channels)
+    titles = ['X_Value'] + ['Voltage_{}'.format(i) for i in range(channels)]
+    with open(path, 'w') as f:
+        f.write(HEADER.format(date='2016/03/01', time=start_time,
+            channels=channels, per_channel=repeated(str(rows)),
+            per_channel_date=repeated('2016/03/01'),
+            per_channel_time=repeated(start_time),
+            units=repeated('Volts'), dimensions=repeated('Time'),
+            x0=repeated('0.0000000000000000E+0'),
+            delta_x=repeated('{:.6E}'.format(delta_x)),
+            titles='\t'.join(titles + ['Comment'])))
+
+        row_format = '\t'.join(['%.6f'] * (channels + 1)) + '\n'
+        for start in range(0, rows, WRITE_ROWS):
+            n = min(WRITE_ROWS, rows - start)
+            i = np.arange(start, start + n)
+            x = i * delta_x
+            columns = [x]
+            # input: a slow square wave, the phase of the experiment
+            columns.append(np.where((x // 10) % 2, 1., 0.) +
+                noise * random.randn(n))
+            output = .5 + drift * np.sin(2 * np.pi * x / max(duration, 1)) + \
+                noise * random.randn(n)
+            for s in spikes[(spikes > start - spike_width) &
+                (spikes < start + n)]:
+                lo, hi = max(s, start), min(s + spike_width, start + n)
+                output[lo - start:hi - start] -= dip[lo - s:hi - s]
+            columns.append(output)
+            for c in range(2, channels):
+                columns.append(.5 + noise * random.randn(n))
+
+            values = np.column_stack(columns).ravel()
+            lines = ((row_format * n) % tuple(values)).split('\n')
+            commented = set(np.flatnonzero(
+                random.rand(n) < comment_rate).tolist())
+            commented.update(s - start for s in marked if start <= s < start + n)
+            if start == 0 and n:
+                commented.add(0) # the vi always writes a first comment
+            for j in commented:
+                lines[j] += '\t{:.3f},{:d}'.format(x[j], (start + j) in marked)
+            f.write('\n'.join(lines))
+    return spikes
+
+
+def measure(stage, repeat=3):
+    """ runs stage() repeat times. returns the best wall time (seconds),
+        and the peak memory (bytes) it allocated on a separate run
+        (None if tracemalloc isn't available).
+        """
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        stage()
+        took = time.time() - start
+        best = took if best is None else min(best, took)
+    peak = None
+    if tracemalloc is not None:
+        tracemalloc.start()
+        try:
+            stage()
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return best, peak
+
+
+def run_benchmarks(path, repeat=3, binsize=20, deg=3, delta=.004,
+    output=True):
+    """ times every stage of the pipeline on the lvm file at path.
+        returns {stage: {'seconds', 'rows per second', 'peak MB'}}
+        """
+    r = parse(path, output=False)
+    x, y = r['X_Value'], r['Voltage_1']
+    rows = len(x)
+    adjusted = moving_average(y, binsize) - polyfit(x, y, deg)
+    stages = [
+        ('parse', lambda: parse(path, output=False)),
+        ('moving_average', lambda: moving_average(y, binsize)),
+        ('polyfit', lambda: polyfit(x, y, deg)),
+        ('find_peaks', lambda: find_peaks(x, adjusted, delta=delta)),
+        ('process_raw_data', lambda: process_raw_data(path, binsize=binsize,
+            deg=deg, delta=delta, output=False, show_plot=False)),
+        ('process_stream', lambda: process_raw_data(path, binsize=binsize,
+            deg=deg, delta=delta, output=False, stream=True)),
+    ]
+    results = {}
+    for name, stage in stages:
+        seconds, peak = measure(stage, repeat=repeat)
+        results[name] = {
+            'seconds': round(seconds, 4),
+            'rows per second': round(rows / seconds) if seconds else None,
+            'peak MB': round(peak / 1e6, 1) if peak is not None else None,
+        }
+        if output: print('{:<18}{:>10.3f} s{:>14,} rows/s{:>10} MB'.format(
+            name, seconds, results[name]['rows per second'] or 0,
+            results[name]['peak MB']))
+    return results
+
+
+def compare(results, baseline, tolerance=.2):
+    """ returns a list of (stage, baseline rows/s, rows/s) for the stages
+        that are more than tolerance (a fraction) slower than the baseline
+        """
+    slower = []
+    for name in results:
+        then = baseline.get(name, {}).get('rows per second')
+        now = results[name]['rows per second']
+        if then and now and now < then * (1 - tolerance):
+            slower.append((name, then, now))
+    return slower
+
+
+def load_baselines(path=DEFAULT_BASELINE):
+    """ returns the saved baselines, {config: results} """
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_baseline(config, results, path=DEFAULT_BASELINE):
+    """ stores results as the baseline for config """
+    baselines = load_baselines(path)
+    baselines[config] = results
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    with open(path, 'w') as f:
+        json.dump(baselines, f, indent=2, sort_keys=True)
+
+
+def main(argv=None):
+    """ the command line entry point. returns the exit status,
+        1 if a stage regressed against the baseline.
+        """
+    parser = argparse.ArgumentParser(prog='anemia_plotter bench',
+        description='benchmark the pipeline on a synthetic lvm file')
+    parser.add_argument('--rows', type=int, default=10**6)
+    parser.add_argument('--channels', type=int, default=2)
+    parser.add_argument('--spike-rate', type=float, default=2.,
+        help='particles per second')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--directory', default=tempfile.gettempdir(),
+        help='where the synthetic files are written (and reused)')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE,
+        help='json file the baselines are kept in')
+    parser.add_argument('--save-baseline', action='store_true',
+        help='store this run as the baseline')
+    parser.add_argument('--tolerance', type=float, default=.2,
+        help='fraction slower than the baseline that counts as a regression')
+    args = parser.parse_args(argv)
+
+    config = 'rows={} channels={} spike_rate={}'.format(args.rows,
+        args.channels, args.spike_rate)
+    path = os.path.join(args.directory, 'anemia_bench_{}_{}_{}.lvm'.format(
+        args.rows, args.channels, args.spike_rate))
+    if not os.path.exists(path):
+        print('writing {}'.format(path))
+        write_lvm(path, rows=args.rows, channels=args.channels,
+            spike_rate=args.spike_rate)
+
+    print(config)
+    results = run_benchmarks(path, repeat=args.repeat)
+    if args.save_baseline:
+        save_baseline(config, results, args.baseline)
+        print('saved the baseline to {}'.format(args.baseline))
+        return 0
+
+    baseline = load_baselines(args.baseline).get(config)
+    if baseline is None:
+        print('no baseline for this configuration yet (--save-baseline)')
+        return 0
+    slower = compare(results, baseline, args.tolerance)
+    for name, then, now in slower:
+        print('REGRESSION {}: {:,} -> {:,} rows/s'.format(name, then, now))
+    return 1 if slower else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,154 @@
+'''
+    A persistent binary cache for parsed lvm files.
+
+    Every parsed file is stored as a directory holding one .npy file per
+    column and a small meta.json with the header info (delta_x, start_time,
+    sampling frequency, numcols, ...). Loading memory maps the .npy files,
+    so a warm load reads nothing but the metadata until the data is used.
+
+    Entries are keyed by the absolute path of the lvm file and the parse
+    options, and they remember the size and mtime of the file. If the file
+    changes the entry is thrown away. The cache directory is kept under a
+    size cap by evicting the least recently used entries.
+'''
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+
+import numpy as np
+
+DEFAULT_DIRECTORY = os.path.join(os.path.expanduser('~'), '.anemia_plotter',
+    'parse_cache')
+DEFAULT_MAX_BYTES = 2 * 1024 ** 3 # 2GB
+META = 'meta.json'
+
+
+class ParseCache(object):
+    """ Stores and loads the dicts returned by parse_file.parse
+
+        args    -> directory: where the entries live.
+                    defaults to ~/.anemia_plotter/parse_cache
+                -> max_bytes: size cap for the whole directory. the least
+                    recently used entries are removed once it is exceeded.
+        """
+    def __init__(self, directory=None, max_bytes=DEFAULT_MAX_BYTES):
+        self.directory = directory or DEFAULT_DIRECTORY
+        self.max_bytes = max_bytes
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+    def entry(self, filename, options):
+        """ returns the directory of the entry for this file & parse options """
+        key = json.dumps([os.path.abspath(filename), options], sort_keys=True)
+        name = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, name)
+
+    def load(self, filename, options):
+        """ returns the cached parse result, or None if there isn't a valid
+            one. Columns are read-only memory mapped arrays.
+            """
+        entry = self.entry(filename, options)
+        meta_path = os.path.join(entry, META)
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+            current = fingerprint(filename)
+        except (IOError, OSError, ValueError):
+            return None
+
+        if meta['fingerprint'] != current:
+            # the file changed since it was cached.
+            shutil.rmtree(entry, ignore_errors=True)
+            return None
+
+        try:
+            result = {k: np.load(os.path.join(entry, k + '.npy'),
+                mmap_mode='r') for k in meta['columns']}
+        except (IOError, OSError, ValueError):
+            shutil.rmtree(entry, ignore_errors=True)
+            return None
+        result.update(meta['header'])
+        os.utime(meta_path, None) # mark as recently used
+        return result
+
+    def store(self, filename, options, result):
+        """ saves a parse result. numpy arrays become columns, everything
+            else must be json serializable and goes into the metadata.
+            """
+        entry = self.entry(filename, options)
+        columns = [k for k in result if isinstance(result[k], np.ndarray)]
+        meta = {
+            'filename': os.path.abspath(filename),
+            'fingerprint': fingerprint(filename),
+            'options': options,
+            'columns': columns,
+            'header': {k: result[k] for k in result if k not in columns},
+        }
+
+        # write everything to a temporary directory, then move it in place
+        # so nobody ever sees half an entry.
+        tmp = tempfile.mkdtemp(dir=self.directory, prefix='.tmp')
+        try:
+            for k in columns:
+                np.save(os.path.join(tmp, k + '.npy'),
+                    np.ascontiguousarray(result[k]))
+            with open(os.path.join(tmp, META), 'w') as f:
+                json.dump(meta, f)
+            shutil.rmtree(entry, ignore_errors=True)
+            os.rename(tmp, entry)
+        except (IOError, OSError):
+            shutil.rmtree(tmp, ignore_errors=True) # someone else won the race
+        self.evict()
+
+    def entries(self):
+        """ returns a list of (last used, bytes, directory) for every entry """
+        found = []
+        for name in os.listdir(self.directory):
+            entry = os.path.join(self.directory, name)
+            meta_path = os.path.join(entry, META)
+            if name.startswith('.') or not os.path.exists(meta_path):
+                continue
+            size = sum(os.path.getsize(os.path.join(entry, f))
+                for f in os.listdir(entry))
+            found.append((os.path.getmtime(meta_path), size, entry))
+        return found
+
+    def evict(self):
+        """ removes the least recently used entries until the cache fits
+            within max_bytes.
+            """
+        found = sorted(self.entries())
+        total = sum(size for _, size, _ in found)
+        while found and total > self.max_bytes:
+            _, size, entry = found.pop(0)
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+
+    def clear(self):
+        """ removes every entry """
+        for _, _, entry in self.entries():
+            shutil.rmtree(entry, ignore_errors=True)
+
+
+def fingerprint(filename):
+    """ size and modification time of a file. changes when the file does """
+    st = os.stat(filename)
+    return [st.st_size, repr(st.st_mtime)]
+
+
+def get_cache(cache):
+    """ turns the cache argument of parse into a ParseCache (or None)
+        -> None/False : no caching
+        -> True : the default cache directory
+        -> a string : a cache in that directory
+        -> a ParseCache : used as is
+        """
+    if cache is None or cache is False:
+        return None
+    if cache is True:
+        return ParseCache()
+    if isinstance(cache, ParseCache):
+        return cache
+    return ParseCache(directory=cache)
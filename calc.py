@@ -1,10 +1,13 @@
-import math
-
-from numpy import mean, polyfit as pf, polyval, \
-resize, reshape, max, min
-from scipy.signal import butter, filtfilt, freqz
+from numpy import mean, max, min, asarray, float64, concatenate, repeat, \
+arange, clip, cumsum, empty, zeros, array, dot, floor, diff, flatnonzero, \
+searchsorted, unique
+from numpy.linalg import lstsq
+from numpy.polynomial.legendre import legvander, legval
 from peakdetect import peakdet
-from scipy.stats import sem, t
+from instrument import log
+# scipy is imported where it's used, it is slow to import.
+
+CHUNK = 1 << 20 # points handled at a time by the chunked calculations
 
 
 def esimate_noise_amplitude(y,confidence=.95):
@@ -26,6 +29,7 @@ def esimate_noise_amplitude(y,confidence=.95):
         RETURNS ----
         low estimate, high estimate, mean, std error, degrees of freedom
         """
+    from scipy.stats import sem, t
     m = mean(y)
     s = sem(y)
     n = len(y)
@@ -37,75 +41,397 @@ def find_peaks(x,y, delta = .004):
     """ this applies the peak detection algorithm. 
         look at the source code to find out....
         """
-    print('x', len(x))
-    print('y',len(y))
-    print('delta',delta)
+    log.debug('find_peaks: x %d, y %d, delta %s', len(x), len(y), delta)
     mx,mn= peakdet(y,delta,x=x)
     
     return mx.T,mn.T
 
 
-def polyfit(x,y,d=3):
+def polyfit(x,y,d=3, segment=None, chunk=CHUNK):
     """ Returns an array of the same length as y/x 
         that contains the y values computed from the best fit polynomial 
         of degree = d
+
+        The fit is done by PolyfitAccumulator, chunk points at a time, on x 
+        scaled to [-1, 1]. So it stays well conditioned on long recordings 
+        with large time offsets and never builds a len(x) by d matrix.
+        
+        -> segment: None fits one polynomial to everything. 
+            a number fits a polynomial to every segment of that length 
+            (in x units, i.e. seconds) instead, see SegmentedFit. 
+            For long runs where the drift doesn't follow a single curve.
+
+        y can also be 2d, one channel per row (all sampled at x). Every 
+        channel is fit in the same pass, the basis is only worked out once.
         """
-    coefs = pf(x,y,d)
-    bestfit = polyval(coefs,x)
-    return bestfit
+    x = asarray(x)
+    y = asarray(y)
+    if not len(x):
+        return empty(y.shape)
+    if segment:
+        fit = SegmentedFit(d=d, length=segment, origin=x[0])
+    else:
+        lo, hi = float(x.min()), float(x.max())
+        fit = PolyfitAccumulator(d=d, center=(lo + hi) / 2., 
+            scale=(hi - lo) / 2. or 1.)
+    for i in range(0, len(x), chunk):
+        fit.update(x[i:i + chunk], y[..., i:i + chunk])
+    return concatenate([fit.evaluate(x[i:i + chunk]) 
+        for i in range(0, len(x), chunk)], axis=-1)
 
 
-def moving_average(a, n=10):
+def moving_average(a, n=10, mode='binned', dtype=None):
     """ Returns an array filled with moving averages
         The returned array will be the same length as a.
             thererefore you don't need to do anything weird to the x values. 
 
-        moving average is calculated by taking n points and averaging them
-        then replace those n points by the average.
-        continue for all points. 
+        modes:
+        'binned' (default)
+            moving average is calculated by taking n points and averaging them
+            then replace those n points by the average.
+            continue for all points. 
+
+            If the array doesn't nicely fall into bins of n points, the array is 
+            extended by repeating the last element. thererefore the average for 
+            that bin will be close to the last number of the bin. This could 
+            substatialy change. but probably better than the alternatives.
+                the extra indices are then cut off. and the answer returned. 
+                probably don't trust the last bin. unless you're sure. 
+        'centered'
+            a true sliding window. every point is replaced by the average of 
+            the n points around it. near the ends the window is cut short.
+        'trailing'
+            every point is replaced by the average of itself and the n-1 points
+            before it. the first n-1 points average what's available.
+
+        Everything is done with whole array operations (one reshape/mean/repeat 
+        for bins, one cumulative sum for sliding windows), so the cost is 
+        linear in len(a) whatever n is. 
 
-        If the array doesn't nicely fall into bins of n points, the array is extended by 
-        repeating the last element. thererefore the average for that bin will be close to
-        the last number of the bin. This could substatialy change. but probably better than 
-        the alternatives.
-            the extra indices are then cut off. and the answer returned. 
-            probably don't trust the last bin. unless you're sure. 
+        args    -> a = array to calculate over. 1d, or 2d with one channel 
+                    per row (every row is averaged on its own, in the same
+                    array operations)
+                -> n = number of datapoints to bin / window width
+                -> mode = 'binned', 'centered' or 'trailing'
+                -> dtype = dtype of the result. defaults to float64, 
+                    float32 halves the memory. 
+        """
+    a = asarray(a)
+    dtype = dtype or float64
+    length = a.shape[-1]
+    if length == 0:
+        return a.astype(dtype)
+    if mode == 'binned':
+        full = length // n * n
+        means = a[..., :full].reshape(a.shape[:-1] + (-1, n)).mean(axis=-1)
+        if full < length: # the last bin is padded with the last value
+            last = concatenate((a[..., full:], 
+                repeat(a[..., -1:], n - (length - full), axis=-1)), axis=-1)
+            means = concatenate((means, last.mean(axis=-1)[..., None]), 
+                axis=-1)
+        return repeat(means.astype(dtype), n, axis=-1)[..., :length]
+
+    if mode not in ('centered', 'trailing'):
+        raise ValueError('Unknown moving average mode {}'.format(mode))
+    # window i covers a[i - before : i + after + 1]
+    if mode == 'trailing':
+        before, after = n - 1, 0
+    else:
+        before, after = n // 2, (n - 1) // 2
+    # sums relative to the first value keep the cumulative sum small
+    ref = a[..., :1]
+    sums = concatenate((zeros(a.shape[:-1] + (1,)), 
+        cumsum(a - ref, axis=-1, dtype=float64)), axis=-1)
+    out = empty(a.shape, dtype=float64)
+    if length >= n: # every window that fits inside a is a difference of sums
+        out[..., before:length - after] = (sums[..., n:] - sums[..., :-n]) / n
+    # the windows near the ends are cut short
+    # (min & max here are numpy's, hence the conditionals)
+    head = arange(before if before < length else length)
+    tail = arange(length - after if length - after > len(head) else len(head),
+        length)
+    edges = concatenate((head, tail))
+    lo = clip(edges - before, 0, length)
+    hi = clip(edges + after + 1, 0, length)
+    out[..., edges] = (sums[..., hi] - sums[..., lo]) / (hi - lo)
+    out += ref
+    return out.astype(dtype, copy=False)
+
+
+class MovingAverage(object):
+    """ moving_average, one chunk at a time. 
 
-        args    -> a = array to calculate over (1d)
-                -> n = number of datapoints to bin
+        update takes the next chunk of the signal and returns the smoothed
+        values of every sample whose window is complete. The rest is held 
+        back until the next chunk (or flush) comes in. Put together, the 
+        returned pieces are the same as moving_average of the whole signal.
+            binned: whole bins are returned, a partial bin is held back.
+            trailing: every sample is returned at once.
+            centered: the last (n-1)/2 samples are held back.
+        Only about n samples are kept between chunks.
+
+        args are the same as moving_average
         """
-        # resizes the array
-    len_orig = len(a)
-    resized = resize(a, math.ceil(float(len(a))/n)*n)
-    len_resized = len(resized)
-    added_indices = len_resized - len_orig 
-    # for any indices added we just want to repeat the last value. 
-        # not repeat the whole array
-    last_index = a[-1]
-    for i in reversed(xrange(added_indices)):
-        resized[-1*i - 1] = last_index
-
-    binned = reshape(resized,(-1,n)) 
-        # turns 1d array into x rows of n cols.     
-    for i,b in enumerate(binned):
-        ave = mean(b)
-        b = [ave for l in b] # set the whole of b to be the average
-        binned[i] = b
-    # turn it back into a 1d array
-    unfurled = reshape(binned, -1)
-    return unfurled[0:len_resized - added_indices] # don't return the extra indeces created during reshaping
-
-
-def filter(data, order=5, cutoff=.001, btype='high'):
+    def __init__(self, n=10, mode='binned', dtype=None):
+        if mode not in ('binned', 'centered', 'trailing'):
+            raise ValueError('Unknown moving average mode {}'.format(mode))
+        self.n = n
+        self.mode = mode
+        self.dtype = dtype
+        if mode == 'binned':
+            self.before, self.after = 0, 0
+        elif mode == 'trailing':
+            self.before, self.after = n - 1, 0
+        else:
+            self.before, self.after = n // 2, (n - 1) // 2
+        self.context = empty(0) # samples already returned, still in a window
+        self.pending = empty(0) # samples not returned yet
+
+    def update(self, a):
+        """ returns the smoothed values that are final so far """
+        data = concatenate((self.context, self.pending, asarray(a)))
+        start = len(self.context)
+        if self.mode == 'binned':
+            stop = len(data) // self.n * self.n
+        else:
+            stop = len(data) - self.after if len(data) > self.after else 0
+            stop = stop if stop > start else start
+        return self._emit(data, start, stop)
+
+    def flush(self):
+        """ returns whatever is left, at the end of the signal """
+        data = concatenate((self.context, self.pending))
+        return self._emit(data, len(self.context), len(data))
+
+    def _emit(self, data, start, stop):
+        if stop > start:
+            smoothed = moving_average(data[:stop + self.after], self.n, 
+                mode=self.mode, dtype=self.dtype)[start:stop]
+        else:
+            smoothed = empty(0, dtype=self.dtype or float64)
+        context_start = stop - self.before if stop > self.before else 0
+        self.context = data[context_start:stop]
+        self.pending = data[stop:]
+        return smoothed
+
+
+class PolyfitAccumulator(object):
+    """ least squares polynomial fit, built up one chunk at a time. 
+
+        Only the sufficient statistics are kept: the gram matrix of the 
+        basis functions and their products with y. Those just add up, so any
+        amount of data can go through it in one pass (or in pieces that are
+        merged afterwards).
+
+        The polynomial is written in legendre polynomials of t, where t is 
+        x moved and scaled to [-1, 1] with center and scale. Over [-1, 1] 
+        they are close to orthogonal, so the gram matrix is well conditioned
+        even on multi-hour recordings whose x is seconds since some offset 
+        (numpy.polyfit's monomials of x aren't). center and scale don't have
+        to be exact, a rough guess of the middle and half width of x is fine.
+
+        y can be 2d, one channel per row. Each channel gets its own fit, 
+        the gram matrix is shared.
+
+        args    -> d: degree of the polynomial
+                -> center, scale: t = (x - center) / scale
+        """
+    def __init__(self, d=3, center=0., scale=1.):
+        self.d = d
+        self.center = center
+        self.scale = scale
+        self.gram = zeros((d + 1, d + 1)) # sum of P_i(t) * P_j(t)
+        self.moments = zeros(d + 1)       # sum of y * P_i(t), per channel
+        self.count = 0
+        self._coefs = None
+
+    def update(self, x, y):
+        """ adds a chunk of points """
+        basis = legvander(self._scaled(x), self.d)
+        self.gram += dot(basis.T, basis)
+        self.moments = self.moments + dot(asarray(y, dtype=float64), basis)
+        self.count += len(basis)
+        self._coefs = None
+
+    def merge(self, other):
+        """ adds the points of another accumulator with the same d, center
+            and scale (e.g. one that went through another part of the file)
+            """
+        self.gram += other.gram
+        self.moments = self.moments + other.moments
+        self.count += other.count
+        self._coefs = None
+
+    def coefficients(self):
+        """ returns the legendre coefficients of the fit in t, lowest 
+            degree first, ready for legval((x - center) / scale, coefs).
+            a column per channel for 2d y.
+            """
+        if self._coefs is None:
+            self._coefs = lstsq(self.gram, self.moments.T, rcond=None)[0]
+        return self._coefs
+
+    def evaluate(self, x):
+        """ returns the fitted polynomial at x, a row per channel for 2d y
+            """
+        return legval(self._scaled(x), self.coefficients())
+
+    def _scaled(self, x):
+        return (asarray(x, dtype=float64) - self.center) / self.scale
+
+
+class SegmentedFit(object):
+    """ piecewise polynomial drift, one chunk at a time. 
+
+        x is cut into segments of the given length starting at origin, and 
+        each segment gets its own PolyfitAccumulator. So the drift of a 
+        multi-hour run doesn't have to follow one polynomial, and the 
+        whole thing still only needs one pass over the data.
+
+        To not leave steps at the segment edges (which would look like 
+        particles), the fits of neighbouring segments are blended: between 
+        the middles of two segments the curve fades linearly from one fit 
+        to the other. Before the first middle and after the last one, the 
+        nearest fit is used as is.
+
+        args    -> d: degree of each polynomial
+                -> length: length of the segments, in x units (seconds)
+                -> origin: x where the first segment starts. defaults to the
+                    first x seen.
+        """
+    def __init__(self, d=3, length=600., origin=None):
+        self.d = d
+        self.length = float(length)
+        self.origin = origin
+        self.fits = {} # segment number -> PolyfitAccumulator
+
+    def update(self, x, y):
+        """ adds a chunk of points. x must be increasing, y is 1d or a row 
+            per channel
+            """
+        x = asarray(x, dtype=float64)
+        y = asarray(y)
+        if not len(x):
+            return
+        if self.origin is None:
+            self.origin = x[0]
+        segment = floor((x - self.origin) / self.length).astype(int)
+        edges = flatnonzero(diff(segment)) + 1
+        for lo, hi in zip(concatenate(([0], edges)), 
+            concatenate((edges, [len(x)]))):
+            self._fit(segment[lo]).update(x[lo:hi], y[..., lo:hi])
+
+    def evaluate(self, x):
+        """ returns the blended piecewise fit at x """
+        x = asarray(x, dtype=float64)
+        numbers = sorted(self.fits)
+        if not numbers:
+            return zeros(len(x))
+        if len(numbers) == 1:
+            return self.fits[numbers[0]].evaluate(x)
+        middles = self.origin + (array(numbers) + .5) * self.length
+        channels = self.fits[numbers[0]].coefficients().shape[1:]
+        # the pair of fits each x falls between, & how far along it is
+        right = clip(searchsorted(middles, x), 1, len(numbers) - 1)
+        left = right - 1
+        weight = clip((x - middles[left]) / (middles[right] - middles[left]),
+            0, 1)
+        bestfit = empty(channels + (len(x),))
+        for i in unique(left):
+            at = left == i
+            ours, theirs = self.fits[numbers[i]], self.fits[numbers[i + 1]]
+            w = weight[at]
+            bestfit[..., at] = (1 - w) * ours.evaluate(x[at]) + \
+                w * theirs.evaluate(x[at])
+        return bestfit
+
+    def _fit(self, number):
+        if number not in self.fits:
+            center = self.origin + (number + .5) * self.length
+            self.fits[number] = PolyfitAccumulator(d=self.d, center=center, 
+                scale=self.length / 2.)
+        return self.fits[number]
+
+
+FILTER_DESIGNS = {} # (order, cutoff, btype) -> second order sections
+
+
+def butter_sos(order=5, cutoff=.001, btype='high', fs=None):
+    """ the second order sections of a butterworth filter. 
+        designs are cached, they're the same for every chunk & every file
+        with the same sampling frequency.
+
+        args    -> order
+                -> cutoff: Hz if fs is given, else a fraction of the 
+                    nyquist frequency (as scipy.signal.butter). a pair of 
+                    them for bandpass/bandstop.
+                -> btype: high, low, bandpass, bandstop
+                -> fs: sampling frequency (Hz)
+        """
+    cutoff = tuple(asarray(cutoff, dtype=float64).ravel())
+    if fs is not None:
+        cutoff = tuple(c / (fs / 2.) for c in cutoff)
+    key = (order, cutoff, btype)
+    if key not in FILTER_DESIGNS:
+        from scipy.signal import butter
+        FILTER_DESIGNS[key] = butter(order, 
+            cutoff[0] if len(cutoff) == 1 else cutoff, btype=btype, 
+            output='sos')
+    return FILTER_DESIGNS[key]
+
+
+def filter(data, order=5, cutoff=.001, btype='high', fs=None, causal=False):
     """ returns a filtered set of data. 
         filtered by applying a butterworth filter
         of order (5),
-        with cutoff (.001Hz)
+        with cutoff (.001 of the nyquist frequency, or Hz if fs is given)
         and type = (high, low, bandpass, bandstop)
+
+        The filter runs as second order sections, which stay accurate at 
+        the tiny cutoffs drift removal needs (b, a coefficients don't).
+        causal=False runs it forwards & backwards (no phase shift), 
+        causal=True only forwards, which is what ButterworthFilter does one
+        chunk at a time.
+        2d data is filtered along its rows, one channel per row.
         """
-    b,a = butter(order,cutoff,btype=btype)
-    data = filtfilt(b,a,data)
-    return data
+    if causal:
+        return ButterworthFilter(order, cutoff, btype, fs).update(data)
+    from scipy.signal import sosfiltfilt
+    return sosfiltfilt(butter_sos(order, cutoff, btype, fs), data)
+
+
+class ButterworthFilter(object):
+    """ filter(causal=True), one chunk at a time. 
+
+        update takes the next chunk of the signal and returns it filtered,
+        the state of the filter is carried over to the next chunk. Put 
+        together, the returned pieces are the same as filtering the whole 
+        signal at once. The filter starts out settled on the first sample, 
+        so a high pass starts at 0 instead of ringing. Chunks can be 2d, a
+        row per channel.
+
+        args are the same as filter
+        """
+    def __init__(self, order=5, cutoff=.001, btype='high', fs=None):
+        self.sos = butter_sos(order, cutoff, btype, fs)
+        self.zi = None
+
+    def update(self, a):
+        from scipy.signal import sosfilt, sosfilt_zi
+        a = asarray(a, dtype=float64)
+        if not a.shape[-1]:
+            return a.copy()
+        if self.zi is None: # (sections, channels.., 2)
+            zi = sosfilt_zi(self.sos)
+            self.zi = zi.reshape(zi.shape[:1] + (1,) * (a.ndim - 1) + 
+                zi.shape[1:]) * a[..., 0][None, ..., None]
+        filtered, self.zi = sosfilt(self.sos, a, zi=self.zi)
+        return filtered
+
+    def flush(self):
+        """ nothing is held back, here to match MovingAverage """
+        return empty(0)
+
 
 def minarray(y):
     ''' returns an array which is a line along the minimum 
@@ -0,0 +1,234 @@
+'''
+    Columnar binary datasets, converted from lvm files.
+
+        python -m anemia_plotter convert <file.lvm|dir|glob> ... \
+            [--compress] [--dtype float32] [--columns X_Value Voltage_1 ...]
+
+    Parsing text is most of the cost of looking at a run, and it's paid
+    again every time. A dataset is a directory (file.lvd by default) with
+        <column>.npy    one contiguous array per column
+        meta.json       the header info parse extracts (delta_x,
+                        start_time, ...), the number of rows, the columns
+                        and the lvm file it came from
+    Compressed datasets (for old runs) keep the columns in one zip,
+    columns.npz, instead of the .npy files.
+
+    parse_file.parse & iter_parse open a dataset like an lvm file. The .npy
+    files are memory mapped, so opening one takes milliseconds however big
+    it is and only the pages that are used are ever read. Compressed columns
+    are decompressed into memory when they're loaded.
+
+    The Comment column isn't stored (it's text), manual_particle_detector
+    is.
+'''
+import os
+import sys
+import json
+import glob
+import shutil
+import struct
+import zipfile
+import argparse
+
+import numpy as np
+
+from cache import fingerprint
+
+FORMAT = 1 # version of the layout
+EXTENSION = '.lvd'
+META = 'meta.json'
+COMPRESSED = 'columns.npz'
+NPY_HEADER = 128 # bytes of the .npy headers written here
+
+
+def is_dataset(path):
+    """ True if path is a dataset directory """
+    return bool(path) and os.path.isfile(os.path.join(path, META))
+
+
+def read_meta(path):
+    """ the metadata of the dataset at path """
+    with open(os.path.join(path, META)) as f:
+        meta = json.load(f)
+    if meta.get('format', 0) > FORMAT:
+        raise ValueError('{} was written by a newer version (format {})'.format(
+            path, meta['format']))
+    return meta
+
+
+def load_dataset(path, columns=None):
+    """ opens the dataset at path.
+
+        args    -> columns: names of the columns to load, None for all.
+        returns meta, {column: array}. uncompressed columns are read-only
+            memory maps.
+        """
+    meta = read_meta(path)
+    names = meta['columns'] if columns is None else list(columns)
+    unknown = set(names) - set(meta['columns'])
+    if unknown:
+        raise ValueError('No column(s) {} in {}, it has {}'.format(
+            ', '.join(sorted(unknown)), path, meta['columns']))
+    if meta['compressed']:
+        with np.load(os.path.join(path, COMPRESSED)) as npz:
+            data = {k: npz[k] for k in names}
+    else:
+        data = {k: np.load(os.path.join(path, k + '.npy'), mmap_mode='r')
+            for k in names}
+    return meta, data
+
+
+def npy_header(dtype, rows):
+    """ a .npy (version 1.0) header for a 1d array, always NPY_HEADER bytes
+        long so it can be written before the number of rows is known and
+        rewritten after.
+        """
+    description = "{{'descr': {!r}, 'fortran_order': False, 'shape': ({:d},), }}" \
+        .format(str(np.lib.format.dtype_to_descr(np.dtype(dtype))), rows)
+    return b'\x93NUMPY\x01\x00' + struct.pack('<H', NPY_HEADER - 10) + \
+        (description.ljust(NPY_HEADER - 11) + '\n').encode('latin-1')
+
+
+def convert(filename, destination=None, columns=None, dtype=np.float64,
+    compress=False, output=True, **kwargs):
+    """ Converts an lvm file to a dataset.
+
+        The file is parsed a block at a time (parse_file.iter_parse) and
+        every block is appended to the column files, so any size of file
+        can be converted in about a block's worth of memory.
+
+        args    -> filename: the lvm file
+                -> destination: the dataset directory. defaults to the lvm
+                    file with .lvd instead of .lvm. replaced if it exists.
+                -> columns: the columns to keep, None for all of them
+                    (but Comment)
+                -> dtype: of the numeric columns
+                -> compress: compress the dataset once it's written
+                -> anything else goes to iter_parse (blocksize, header_lines..)
+        returns the dataset directory
+        """
+    from parse_file import iter_parse # parse_file opens datasets itself
+    if columns is not None and 'Comment' in columns:
+        raise ValueError('the Comment column can not be stored')
+    destination = destination or os.path.splitext(filename)[0] + EXTENSION
+    header, chunks = iter_parse(filename=filename, columns=columns,
+        dtype=dtype, output=output, **kwargs)
+    names = header['columns']
+
+    # written next to the destination, then moved in place
+    tmp = destination.rstrip(os.sep) + '.tmp{}'.format(os.getpid())
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+    files, dtypes, rows = {}, {}, 0
+    try:
+        for k in names:
+            files[k] = open(os.path.join(tmp, k + '.npy'), 'wb')
+        for c in chunks:
+            for k in names:
+                dtypes[k] = c[k].dtype
+                if files[k].tell() == 0:
+                    files[k].write(npy_header(dtypes[k], 0))
+                np.ascontiguousarray(c[k]).tofile(files[k])
+            rows += len(c[names[0]]) if names else 0
+        for k in names: # now that the number of rows is known
+            files[k].seek(0)
+            files[k].write(npy_header(dtypes.get(k, dtype), rows))
+            files[k].close()
+
+        meta = {
+            'format': FORMAT,
+            'rows': rows,
+            'columns': names,
+            'compressed': False,
+            'header': {k: header[k] for k in ('numcols', 'delta_x',
+                'start_time', 'sampling frequency', 'column_titles')},
+            'source': {
+                'filename': os.path.abspath(filename),
+                'fingerprint': fingerprint(filename),
+            },
+        }
+        with open(os.path.join(tmp, META), 'w') as f:
+            json.dump(meta, f, indent=1)
+        shutil.rmtree(destination, ignore_errors=True)
+        os.rename(tmp, destination)
+    except BaseException:
+        for f in files.values():
+            f.close()
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+    if output: print('convert: {} -> {} ({} rows)'.format(filename,
+        destination, rows))
+    if compress:
+        compress_dataset(destination, output=output)
+    return destination
+
+
+def compress_dataset(path, output=True):
+    """ moves the columns of the dataset at path into one compressed zip.
+        it can still be opened by parse, but has to be decompressed into
+        memory. does nothing if it's compressed already.
+        """
+    meta = read_meta(path)
+    if meta['compressed']:
+        return path
+    target = os.path.join(path, COMPRESSED)
+    with zipfile.ZipFile(target + '.tmp', 'w', zipfile.ZIP_DEFLATED,
+        allowZip64=True) as z:
+        for k in meta['columns']:
+            z.write(os.path.join(path, k + '.npy'), k + '.npy')
+    os.rename(target + '.tmp', target)
+    meta['compressed'] = True
+    with open(os.path.join(path, META), 'w') as f:
+        json.dump(meta, f, indent=1)
+    before = 0
+    for k in meta['columns']:
+        before += os.path.getsize(os.path.join(path, k + '.npy'))
+        os.remove(os.path.join(path, k + '.npy'))
+    if output: print('compress: {} {:.1f} -> {:.1f} MB'.format(path,
+        before / 1e6, os.path.getsize(target) / 1e6))
+    return path
+
+
+def main(argv=None):
+    """ the command line entry point. returns the exit status """
+    parser = argparse.ArgumentParser(prog='anemia_plotter convert',
+        description='convert lvm files to binary datasets')
+    parser.add_argument('patterns', nargs='+',
+        help='lvm files, directories or glob patterns. '
+        'existing datasets are compressed with --compress')
+    parser.add_argument('-o', '--directory', default=None,
+        help='where the datasets go. defaults to next to the lvm files')
+    parser.add_argument('--compress', action='store_true')
+    parser.add_argument('--dtype', default='float64',
+        choices=['float64', 'float32'])
+    parser.add_argument('--columns', nargs='+', default=None,
+        help='columns to keep, all of them by default')
+    parser.add_argument('-q', '--quiet', action='store_true')
+    args = parser.parse_args(argv)
+
+    paths = []
+    for p in args.patterns:
+        if is_dataset(p):
+            paths.append(p)
+        elif os.path.isdir(p):
+            paths.extend(sorted(os.path.join(p, f) for f in os.listdir(p)
+                if f.lower().endswith('.lvm')))
+        else:
+            paths.extend(sorted(glob.glob(p)))
+    for p in paths:
+        if is_dataset(p):
+            if args.compress:
+                compress_dataset(p, output=not args.quiet)
+            continue
+        destination = None
+        if args.directory:
+            destination = os.path.join(args.directory,
+                os.path.splitext(os.path.basename(p))[0] + EXTENSION)
+        convert(p, destination, columns=args.columns,
+            dtype=np.dtype(args.dtype), compress=args.compress,
+            output=not args.quiet)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,212 @@
+'''
+    Processing an lvm file while acquisition.vi is still writing it.
+
+    The file is polled for newly appended lines. Only complete lines are
+    parsed; a partial line at the end of the file is left alone until its
+    newline shows up. Each new piece goes through the same smoothing,
+    drift removal and peak detection as process_raw_data, one chunk at a
+    time, so the particle count is kept up to date as the data comes in.
+
+    Drift removal can't wait for the end of the run here, so the polynomial
+    is fitted to everything seen so far and new samples are adjusted with
+    the current fit.
+
+    Only the last `keep` samples of the signal are held on to, so memory
+    stays flat over a run of any length.
+'''
+import os
+import time
+
+from numpy import concatenate, empty, array
+
+from parse_file import read_header, BlockParser, BLOCK_SIZE, HEADER_LINES, \
+    HEADER_SCHEME
+from calc import PolyfitAccumulator
+from processing import OutputStream
+
+
+class Follower(object):
+    """ Keeps track of a growing lvm file. call poll to process whatever
+        was appended since the last call.
+
+        args    -> filename: the lvm file being written
+                -> maxima, binsize, deg, delta, smoothing: as process_raw_data
+                -> keep: number of recent samples of x/smoothed/adjusted
+                    that are kept (for plotting, say).
+                -> fit_span: seconds. the time axis of the drift fit is
+                    scaled by this, about the length of a run is good.
+                -> blocksize: most bytes parsed in one go
+        """
+    def __init__(self, filename,
+        maxima=None,
+        binsize=20,
+        deg=3,
+        delta=.004,
+        smoothing='binned',
+        keep=100000,
+        fit_span=3600.,
+        blocksize=BLOCK_SIZE,
+        header_lines=HEADER_LINES,
+        header_scheme=HEADER_SCHEME,
+        output=True):
+        self.filename = filename
+        self.maxima = maxima
+        self.binsize = binsize
+        self.deg = deg
+        self.delta = delta
+        self.smoothing = smoothing
+        self.keep = keep
+        self.fit_span = fit_span
+        self.blocksize = blocksize
+        self.header_lines = header_lines
+        self.header_scheme = header_scheme
+        self.output = output
+        self.reset()
+
+    def reset(self):
+        """ forgets everything, back to the start of the file """
+        self.header = None
+        self.position = 0 # byte offset of the first unread line
+        self.reader = None
+        self.fit = None
+        self.stage = None
+        self.rows = 0
+        self.input_sum = self.output_sum = 0.
+        self.peaks = [] # the peak tables found so far
+        self.count = 0
+        self.recent = {k: empty(0) for k in ('x', 'smoothed', 'adjusted')}
+
+    def poll(self):
+        """ processes the complete lines appended since the last poll.
+            returns a dict of the newly final part of the signal
+            (x, smoothed, adjusted, peaks) or None if there was nothing new.
+            """
+        with open(self.filename, 'rb') as f:
+            if self.header is None and not self._read_header(f):
+                return None
+            if os.fstat(f.fileno()).st_size < self.position:
+                # the file was started over.
+                if self.output: print('follow: {} shrank, starting over'.format(
+                    self.filename))
+                self.reset()
+                return None
+
+            found = []
+            while True:
+                f.seek(self.position)
+                block = f.read(self.blocksize)
+                cut = block.rfind(b'\n') + 1
+                if not cut: # nothing new, or only part of a line
+                    break
+                self.position += cut
+                found.append(self._process(block[:cut]))
+        if not found:
+            return None
+        return {k: concatenate([p[k] for p in found]) for k in found[0]}
+
+    def flush(self):
+        """ processes what the smoother was holding back. call it once the
+            acquisition is over. returns the same as poll.
+            """
+        if self.stage is None:
+            return None
+        return self._collect(self.stage.flush())
+
+    def summary(self):
+        """ returns the counts & peak tables so far, like process_stream """
+        peaks = (concatenate(self.peaks) if self.peaks else array([])).T
+        r = {k: self.header[k] for k in ('numcols', 'delta_x', 'start_time',
+            'sampling frequency')} if self.header else {}
+        r['filename'] = self.filename
+        r['rows'] = self.rows
+        r['input ave'] = self.input_sum / self.rows if self.rows else float('nan')
+        r['output ave'] = self.output_sum / self.rows if self.rows else float('nan')
+        r['bin size'] = self.binsize
+        r['smoothing'] = self.smoothing
+        r['deg'] = self.deg
+        r['particles'] = peaks
+        r['number of particles'] = self.count
+        r['max'] = self.maxima
+        r['delta'] = self.delta
+        return r
+
+    def _read_header(self, f):
+        """ reads the header once it has been written completely """
+        for i in range(self.header_lines):
+            if not f.readline().endswith(b'\n'):
+                return False
+        f.seek(0)
+        self.header = read_header(f, self.header_lines, self.header_scheme,
+            output=self.output)
+        self.position = f.tell()
+        self.reader = BlockParser(self.header['column_titles'],
+            columns=['X_Value', 'Voltage_0', 'Voltage_1'])
+        return True
+
+    def _process(self, block):
+        """ one block of complete lines through the pipeline """
+        columns = self.reader.parse_block(block)
+        x, y = columns['X_Value'], columns['Voltage_1']
+        if not len(x):
+            return self._collect(None)
+        if self.fit is None:
+            self.fit = PolyfitAccumulator(d=self.deg, center=x[0],
+                scale=self.fit_span)
+            self.stage = OutputStream(self.fit, binsize=self.binsize,
+                smoothing=self.smoothing, delta=self.delta)
+        self.fit.update(x, y)
+        self.rows += len(x)
+        self.input_sum += columns['Voltage_0'].sum()
+        self.output_sum += y.sum()
+        return self._collect(self.stage.update(x, y))
+
+    def _collect(self, found):
+        """ keeps the new peaks & the recent signal """
+        if found is None:
+            found = {k: empty(0) for k in self.recent}
+            found['peaks'] = empty((0, 2))
+            return found
+        peaks = found['maxtab'] if self.maxima else found['mintab']
+        peaks = peaks.reshape(-1, 2)
+        if len(peaks):
+            self.peaks.append(peaks)
+            self.count += len(peaks)
+        for k in self.recent:
+            self.recent[k] = concatenate((self.recent[k],
+                found[k]))[-self.keep:]
+        found = {k: found[k] for k in self.recent}
+        found['peaks'] = peaks
+        return found
+
+
+def follow(filename, callback=None, interval=.5, idle_timeout=None, **kwargs):
+    """ Follows an lvm file while it is being written.
+
+        args    -> filename: the lvm file. it doesn't have to exist yet.
+                -> callback: called as callback(follower, new) every time
+                    something new was processed. new is what poll returned,
+                    follower.count is the running particle count.
+                -> interval: seconds between polls
+                -> idle_timeout: stop once the file hasn't grown for this
+                    many seconds. None follows until interrupted (ctrl-c).
+                -> anything else goes to Follower (binsize, delta, ...)
+
+        returns the Follower's summary once it stops.
+        """
+    follower = Follower(filename, **kwargs)
+    last_change = time.time()
+    try:
+        while True:
+            new = follower.poll() if os.path.exists(filename) else None
+            if new is not None:
+                last_change = time.time()
+                if callback: callback(follower, new)
+            elif idle_timeout is not None and \
+                time.time() - last_change > idle_timeout:
+                break
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        pass
+    new = follower.flush()
+    if new is not None and callback: callback(follower, new)
+    return follower.summary()
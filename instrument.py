@@ -0,0 +1,115 @@
+'''
+    Timing & memory of the stages of the pipeline.
+
+    process_raw_data wraps each of its stages (parse, smoothing, detrend,
+    peaks, plot) in Instruments.stage, which records
+        wall   seconds on the clock
+        cpu    seconds of cpu time of this process
+        rows   rows handled
+        peak   most bytes allocated at once during the stage (only with
+               memory=True, which uses tracemalloc and slows things down)
+    The records end up in the result under 'timings', and are also logged
+    (INFO) on the 'anemia_plotter.timing' logger with the record attached
+    as record.timing, for anyone who wants them as structured logs.
+
+    The chatty output of the pipeline (array dumps and the like) is logged
+    at DEBUG on the 'anemia_plotter' logger, so it costs nothing unless
+    logging is set up to show it, e.g.
+        logging.basicConfig(level=logging.DEBUG)
+'''
+import time
+import logging
+from contextlib import contextmanager
+
+try:
+    import tracemalloc # numpy reports its allocations to it
+except ImportError: # python 2
+    tracemalloc = None
+
+log = logging.getLogger('anemia_plotter')
+timing_log = logging.getLogger('anemia_plotter.timing')
+cpu_time = getattr(time, 'process_time', time.clock if hasattr(time, 'clock')
+    else time.time)
+
+
+class Instruments(object):
+    """ Collects the timing (& memory) of named stages.
+        A stage that runs more than once (e.g. once per chunk) is added up
+        into one record, with 'calls' counting the runs.
+
+        args    -> memory: also record the peak memory of every stage.
+        """
+    def __init__(self, memory=False):
+        self.records = [] # one dict per stage, in the order they first ran
+        self.by_name = {}
+        self.memory = memory and tracemalloc is not None
+        self.started_tracing = False
+        if self.memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.started_tracing = True
+
+    @contextmanager
+    def stage(self, name, rows=None):
+        """ times the body of the with statement as stage name.
+            yields a dict; set 'rows' on it if they're only known inside.
+            """
+        current = {'rows': rows}
+        if self.memory:
+            if hasattr(tracemalloc, 'reset_peak'):
+                tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+        wall, cpu = time.time(), cpu_time()
+        try:
+            yield current
+        finally:
+            wall, cpu = time.time() - wall, cpu_time() - cpu
+            peak = None
+            if self.memory:
+                peak = tracemalloc.get_traced_memory()[1] - before
+            self._add(name, wall, cpu, current['rows'], peak)
+
+    def iterate(self, name, iterable, rows=None):
+        """ yields from iterable, timing the getting of every item as
+            stage name (for generators that do their work lazily, like
+            the chunks of parse_file.iter_parse).
+            rows: function giving the rows of an item
+            """
+        iterator = iter(iterable)
+        while True:
+            with self.stage(name) as current:
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+                if rows is not None:
+                    current['rows'] = rows(item)
+            yield item
+
+    def finish(self):
+        """ logs the records and returns them. stops tracemalloc if it was
+            started here.
+            """
+        if self.started_tracing:
+            tracemalloc.stop()
+            self.started_tracing = False
+        for r in self.records:
+            timing_log.info('%s: %.3fs wall, %.3fs cpu, %s rows, %s peak bytes',
+                r['stage'], r['wall'], r['cpu'], r['rows'], r['peak'],
+                extra={'timing': r})
+        return self.records
+
+    def _add(self, name, wall, cpu, rows, peak):
+        if name not in self.by_name:
+            record = {'stage': name, 'wall': 0., 'cpu': 0., 'rows': None,
+                'peak': None, 'calls': 0}
+            self.by_name[name] = record
+            self.records.append(record)
+        record = self.by_name[name]
+        record['wall'] += wall
+        record['cpu'] += cpu
+        record['calls'] += 1
+        if rows is not None:
+            record['rows'] = (record['rows'] or 0) + rows
+        if peak is not None:
+            record['peak'] = peak if record['peak'] is None else \
+                max(record['peak'], peak)
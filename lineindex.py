@@ -0,0 +1,201 @@
+'''
+    A sparse index of where the lines of an lvm file start.
+
+    Seeking to row N of a text file means reading everything before it.
+    The index remembers the byte offset of every INDEX_STEP'th row of the
+    data section, so parse can jump to the nearest one and read at most
+    INDEX_STEP - 1 lines to get to any row. Times map to rows through
+    delta_x (and the X_Value of the first row), so a time window is a row
+    range too.
+
+    The index is only built as far as it's been needed, and is saved (as
+    json, in ~/.anemia_plotter/line_index by default) so the next parse of
+    the same file starts from where this one left off. The index remembers
+    the fingerprint (size & mtime, see cache.fingerprint) the file had when
+    it was scanned. A file that hasn't changed since keeps its index. One
+    that grew (acquisition.vi still writing it) keeps it too, if the start
+    and the end of the part that was indexed are still the same and the
+    offsets still fall just after newlines. Anything else gets a new one.
+    Saving is best effort: if the index directory can't be written the 
+    index is just built again next time.
+'''
+import os
+import json
+import hashlib
+
+import numpy as np
+
+from cache import fingerprint
+from instrument import log
+
+DEFAULT_DIRECTORY = os.path.join(os.path.expanduser('~'), '.anemia_plotter',
+    'line_index')
+INDEX_STEP = 4096 # rows between the offsets kept
+SCAN_SIZE = 1 << 20 # bytes read at a time when building the index
+HEAD_SIZE = 4096 # bytes of the start & end of the indexed part checked
+NEWLINE = ord('\n')
+
+
+class LineIndex(object):
+    """ The byte offsets of every step'th row of the data section of an lvm
+        file.
+
+        args    -> filename: the lvm file
+                -> data_start: byte offset of the first row (after the header)
+                -> step: rows between the offsets kept
+                -> directory: where the index is saved. None for the default,
+                    False to not save it.
+        """
+    def __init__(self, filename, data_start, step=INDEX_STEP, directory=None):
+        self.filename = os.path.abspath(filename)
+        self.data_start = data_start
+        self.step = step
+        self.directory = DEFAULT_DIRECTORY if directory is None else directory
+        self.reset()
+        self.load()
+
+    def reset(self):
+        self.offsets = [self.data_start] # offsets[k] is where row k*step starts
+        self.lines = 0 # complete lines scanned
+        self.end = self.data_start # the byte after the last line scanned
+        self.x0 = None # X_Value of the first row
+        self.head = None # checksum of the start of the data
+        self.tail = None # checksum of the end of the data scanned
+        self.fingerprint = None # of the file, when it was scanned
+
+    def path(self):
+        key = json.dumps([self.filename, self.data_start, self.step])
+        return os.path.join(self.directory,
+            hashlib.sha1(key.encode('utf-8')).hexdigest() + '.json')
+
+    def load(self):
+        """ picks up the saved index, if it still fits the file """
+        if not self.directory:
+            return
+        try:
+            with open(self.path()) as f:
+                saved = json.load(f)
+        except (IOError, OSError, ValueError):
+            return
+        try:
+            current = fingerprint(self.filename)
+            if current != saved.get('fingerprint') and not \
+                self.grown(saved, current[0]):
+                return # rewritten (or cut short) since
+        except (IOError, OSError, KeyError, TypeError):
+            return
+        self.offsets = saved['offsets']
+        self.lines = saved['lines']
+        self.end = saved['end']
+        self.x0 = saved['x0']
+        self.head = saved['head']
+        self.tail = saved['tail']
+        self.fingerprint = saved['fingerprint']
+
+    def grown(self, saved, size):
+        """ True if the file only grew since the saved index was made: 
+            the part that was indexed still starts & ends the same, and
+            the last offset & the end are still just after newlines.
+            """
+        end = saved['end']
+        if size <= saved['fingerprint'][0] or size < end:
+            return False
+        if saved['head'] != self.checksum(self.data_start, end) or \
+            saved['tail'] != self.checksum(end - HEAD_SIZE, end):
+            return False
+        with open(self.filename, 'rb') as f:
+            for at in (saved['offsets'][-1], end):
+                if at > self.data_start:
+                    f.seek(at - 1)
+                    if f.read(1) != b'\n':
+                        return False
+        return True
+
+    def save(self):
+        """ writes the index out. if it can't be (no such directory, read
+            only ...) it's only used for this parse.
+            """
+        if not self.directory:
+            return
+        tmp = self.path() + '.tmp{}'.format(os.getpid())
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            with open(tmp, 'w') as f:
+                json.dump({'filename': self.filename, 'offsets': self.offsets,
+                    'lines': self.lines, 'end': self.end, 'x0': self.x0,
+                    'head': self.head, 'tail': self.tail,
+                    'fingerprint': self.fingerprint}, f)
+            os.rename(tmp, self.path())
+        except (IOError, OSError) as e:
+            log.debug('line index of %s not saved: %s', self.filename, e)
+            try:
+                os.remove(tmp)
+            except (IOError, OSError):
+                pass
+
+    def checksum(self, start, end):
+        """ of the data section from start, up to end, at most HEAD_SIZE
+            bytes of it
+            """
+        start = max(start, self.data_start)
+        with open(self.filename, 'rb') as f:
+            f.seek(start)
+            data = f.read(max(min(end - start, HEAD_SIZE), 0))
+        return hashlib.sha1(data).hexdigest()
+
+    def extend(self, row=None):
+        """ scans on until row is indexed (or the end of the file, for None
+            or a row past the end). saves the index if it grew.
+            """
+        if row is not None and row <= self.lines:
+            return
+        start = self.end
+        scanned = fingerprint(self.filename) # before, in case it grows
+        with open(self.filename, 'rb') as f:
+            f.seek(self.end)
+            while row is None or self.lines < row:
+                block = f.read(SCAN_SIZE)
+                ends = np.flatnonzero(np.frombuffer(block, dtype=np.uint8)
+                    == NEWLINE)
+                if not len(ends):
+                    break
+                if self.x0 is None and self.lines == 0:
+                    first = block[:ends[0]].split(b'\t')[0]
+                    self.x0 = float(first) if first.strip() else 0.
+                # line self.lines + i + 1 starts after newline i
+                numbers = self.lines + 1 + np.arange(len(ends))
+                kept = ends[numbers % self.step == 0]
+                self.offsets.extend((self.end + kept + 1).tolist())
+                self.lines += len(ends)
+                self.end += int(ends[-1]) + 1
+                f.seek(self.end)
+        if self.end != start:
+            if self.head is None or start - self.data_start < HEAD_SIZE:
+                self.head = self.checksum(self.data_start, self.end)
+            self.tail = self.checksum(self.end - HEAD_SIZE, self.end)
+            self.fingerprint = scanned
+            self.save()
+
+    def seek(self, f, row):
+        """ moves the open (binary) file f to the start of row.
+            returns the row it got to, less than row if the file is shorter.
+            """
+        self.extend(row)
+        k = min(row // self.step, len(self.offsets) - 1)
+        f.seek(self.offsets[k])
+        at = k * self.step
+        while at < row and f.readline():
+            at += 1
+        return at
+
+    def rows(self):
+        """ the number of complete rows in the file, indexing all of it """
+        self.extend()
+        return self.lines
+
+    def row_at(self, t, delta_x):
+        """ the first row at or after time t (seconds, like X_Value) """
+        self.extend(1)
+        x0 = self.x0 or 0.
+        return max(int(np.ceil((t - x0) / delta_x - 1e-9)), 0)
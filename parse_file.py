@@ -3,25 +3,49 @@
     produced by the `acquisition.vi` labview program.
 
 '''
+import ctypes
+import multiprocessing
+from multiprocessing.sharedctypes import RawArray
+from logging import DEBUG
+
 import numpy as np
-from os import popen2 # to use os' tail command 
 from utils import prettify  # pretty printing 
+from instrument import log  # the array dumps go to the debug log
 from errors import noFileException  # error if no file is given. 
-from Tkinter import Tk # 
-from tkFileDialog import askopenfilename
+from cache import get_cache # persistent cache of parsed files
+from dataset import is_dataset, load_dataset # converted lvm files
+from lineindex import LineIndex # where the rows of a file start
+
+HEADER_LINES = 24 # the header written by acquisition.vi
+HEADER_SCHEME = {   # where the useful things are in it
+    'start_time':11,
+    'delta_x':21,
+    'column_titles':23
+}
+BLOCK_SIZE = 1 << 24 # bytes of the data section tokenized at a time (16MB)
+TAIL_BLOCK_SIZE = 1 << 16 # bytes read per step when reading from the back
+# parse_parallel: bytes the rows per range are estimated from, and how 
+# much bigger than the estimate the space for them is
+SAMPLE_SIZE = 1 << 16
+SLACK = 1.1
+NEWLINE, TAB, SPACE = ord('\n'), ord('\t'), ord(' ')
 
 def parse(filename = None, 
-    lines = 100000, 
+    lines = None, 
     grab_from = 'front', 
     offset = 0, 
     exclusions=['Comment'],
-    header_lines=24,
-    header_scheme={
-        'start_time':11,
-        'delta_x':21,
-        'column_titles':23
-    },
+    header_lines=HEADER_LINES,
+    header_scheme=HEADER_SCHEME,
     output=True,
+    cache=None,
+    columns=None,
+    dtype=np.float64,
+    synthesize_x=False,
+    workers=1,
+    rows=None,
+    window=None,
+    index=True,
     **kwargs):
     
     """ Parses the lvm file produced by the acquisition vi. 
@@ -29,11 +53,35 @@ def parse(filename = None,
         -----------
         -> filename if none provided you will be prompted by a gui
         -> lines. limits file size by grabbing only the first N lines. 
-                defaults to 100,000 lines
+                defaults to None, every line.
         -> grabFrom. do we grab N lines from the front or the back?
             ('front' or 'back')
         -> offset. skip N lines from either the back or the front
-        -> exclusions:
+        -> rows: (first, stop) only parse these rows (stop can be None).
+                instead of lines/grab_from/offset.
+        -> window: (start, stop) seconds, like X_Value. only parse the 
+                rows in this time window (stop can be None).
+                note that with rows, window, an offset or lines from the 
+                back, the comments before the first row parsed aren't 
+                read: Comment & manual_particle_detector are empty (nan) 
+                until the first comment in the rows parsed.
+        -> index: the rows are found with a sparse index of where the lines
+                start (see lineindex.py), so only the rows wanted are read.
+                it is saved for next time, in the default directory (True),
+                a directory of your choice, or not at all (False).
+        -> exclusions: columns left out of the result.
+        -> columns: list of the columns wanted, e.g. 
+                ['X_Value', 'Voltage_0', 'Voltage_1']. None (default) for 
+                all of them but the exclusions, which are ignored when 
+                columns is given. The rest are skipped while parsing, and 
+                the comments are only looked at for manual_particle_detector
+                or Comment, so fewer columns parse faster.
+        -> dtype: of the numeric columns. np.float32 halves the memory.
+        -> synthesize_x: work X_Value out from delta_x (and the first row)
+                instead of parsing it.
+        -> workers: processes the file is parsed with (see parse_parallel).
+                1 (default) parses it here, None uses every cpu. Only 
+                worth it for big files, and only when reading from the front.
         -> header_lines: used to specify the schema for the header.
                         if you update the script you should be able to
                         make this work by respecifying the header info here.
@@ -44,6 +92,15 @@ def parse(filename = None,
                     - start_time
                     - delta_x
         -> output : True/False, print things. or not... up to you. 
+                    the header & the parsed arrays only go to the debug log
+                    (instrument.log), turn that on to see them.
+        -> filename can also be a dataset made by dataset.convert, 
+                which is opened (memory mapped) instead of parsed.
+        -> cache: keep the parsed columns in a binary cache on disk, so 
+                parsing the same file again is near instant. 
+                True for the default cache directory, a directory name, 
+                or a cache.ParseCache. The entry is refreshed when the 
+                file changes. Cached columns are read-only memory maps.
 
         Throws noFileException
         returns a bunch of stuff in a dict. they all have descriptive 
@@ -77,12 +134,89 @@ def parse(filename = None,
 
     seprator = '\t' # we assume these are tab seprated values.
 
+    # a dataset made by dataset.convert, nothing to parse
+    if is_dataset(filename):
+        return parse_dataset(filename, lines=lines, grab_from=grab_from, 
+            offset=offset, exclusions=exclusions, columns=columns, dtype=dtype,
+            rows=rows, window=window)
+
+    # check the cache first
+    cache = get_cache(cache)
+    if cache is not None:
+        filename = getfile(filename, o=False)
+        options = {'lines': lines, 'grab_from': grab_from, 'offset': offset,
+            'exclusions': sorted(exclusions), 'header_lines': header_lines,
+            'header_scheme': header_scheme, 'dtype': np.dtype(dtype).str,
+            'columns': sorted(columns) if columns is not None else None,
+            'synthesize_x': synthesize_x, 'rows': rows, 'window': window}
+        cached = cache.load(filename, options)
+        if cached is not None:
+            if output: print('parse: loaded {} from the cache'.format(filename))
+            return cached
+
     # open the file
-    f = getfile(filename)
+    f = getfile(filename, mode='rb')
 
     # read the header                                          
-    header = [next(f).strip() for x in xrange(header_lines)]   
-    if output: print('\n'.join([str(i) + ':\t' +x  for i,x in enumerate(header)]))
+    header = read_header(f, header_lines, header_scheme, output=output,
+        separator=seprator)
+    column_titles = header['column_titles']
+
+    # ================
+    # Parse the files
+    # ================
+
+    # === Grab the file ================
+    if columns is not None:
+        exclusions = []
+    reader = BlockParser(column_titles, separator=seprator, 
+        keep_comments='Comment' not in exclusions, dtype=dtype, 
+        columns=columns, delta_x=header['delta_x'] if synthesize_x else None)
+
+    # === read the file =============
+    if grab_from == 'back' and lines is not None and rows is None and \
+        window is None: # the end of the file is found by reading backwards
+        datalines = tail(lines, f=f, output=output, offset=offset)
+        parsed = reader.parse_blocks([b''.join(datalines)])
+    else:
+        stop = find_rows(f, header['delta_x'], lines=lines, 
+            grab_from=grab_from, offset=offset, rows=rows, window=window,
+            index=index)
+        parsed = parse_parallel(f, reader, workers, stop=stop) \
+            if workers != 1 else reader.parse_blocks(iter_blocks(f, stop=stop))
+
+    f.close() # we have read the file. close it now.
+
+    # ============
+    # Return stuff
+    # ============
+    to_ret = {k:parsed[k] for k in parsed if k not in exclusions}
+    to_ret['numcols'] = header['numcols']
+    to_ret['delta_x'] = header['delta_x']
+    to_ret['start_time'] = header['start_time']
+    to_ret['sampling frequency'] = header['sampling frequency']
+    to_ret['filename'] = filename
+
+    if cache is not None:
+        cache.store(filename, options, to_ret)
+
+    if log.isEnabledFor(DEBUG): log.debug('parse: %s\n%s', filename, 
+        prettify(to_ret))
+    return to_ret
+
+
+
+def read_header(f, header_lines=HEADER_LINES, header_scheme=HEADER_SCHEME,
+    output=True, separator='\t'):
+    """ reads the header off the top of an open (binary) lvm file.
+        leaves f at the first line of data.
+        returns a dict with
+            start_time, delta_x, sampling frequency, column_titles, numcols
+        """
+    header = [f.readline().decode('latin-1').strip() 
+        for x in range(header_lines)]
+    if log.isEnabledFor(DEBUG): log.debug('header:\n%s', 
+        '\n'.join([str(i) + ':\t' +x  for i,x in enumerate(header)]))
 
     # ================
     # Parse the header
@@ -91,14 +225,14 @@ def parse(filename = None,
     ## === start_time ========================
     start_time_line = header[header_scheme['start_time']]
     # start time line looks like: "Time \t timestr \t timestr"
-    start_time_line_split = start_time_line.split(seprator) 
+    start_time_line_split = start_time_line.split(separator) 
     # ----------
     start_time = start_time_line_split[1][:15] # grab HH:MM:SS.SSSSSSSSSSS
 
     
     ## === sampling frequency ================
     delta_x_line = header[header_scheme['delta_x']]
-    delta_x_line_split = delta_x_line.split(seprator)
+    delta_x_line_split = delta_x_line.split(separator)
     # ---------
     delta_x = float(delta_x_line_split[2])
     sampling_freq = 1/ delta_x
@@ -106,96 +240,632 @@ def parse(filename = None,
     
     # === column titles =====================
     column_title_line = header[header_scheme['column_titles']]
-    column_title_line_split = column_title_line.split(seprator)
+    column_title_line_split = column_title_line.split(separator)
     # ---------
     column_titles = column_title_line_split # grab all the column names
     num_cols = len(column_titles) # the number of columns in the file.  
 
+    return {
+        'start_time': start_time,
+        'delta_x': delta_x,
+        'sampling frequency': sampling_freq,
+        'column_titles': column_titles,
+        'numcols': num_cols,
+    }
 
-    # ================
-    # Parse the files
-    # ================
 
-    # === Grab the file ================
-    datalines = None # container to hold the lines read from the file. 
-    if grab_from == 'back':
-        datalines = tail(lines, f=f, output=output, offset=offset)
-    else:
-        [next(f) for x in xrange(offset)]               # eat the offset lines
-        datalines = f
-
-    # === prep the columns ============
-    columns = {}    # dict to hold column vars
-    columns_map = {} # dict with same keys, but with column index in dat file.
+def iter_parse(filename = None,
+    grab_from = 'front',
+    offset = 0,
+    exclusions=['Comment'],
+    header_lines=HEADER_LINES,
+    header_scheme=HEADER_SCHEME,
+    blocksize=BLOCK_SIZE,
+    output=True,
+    columns=None,
+    dtype=np.float64,
+    synthesize_x=False,
+    lines=None,
+    rows=None,
+    window=None,
+    index=True,
+    **kwargs):
+    """ parse, one block of the file at a time. 
+        For files too big to hold in memory. 
+
+        args are the same as parse plus
+        -> blocksize: bytes of the file parsed per chunk (16MB by default)
+
+        returns header, chunks
+            header: dict of the header info that parse also returns 
+                (numcols, delta_x, start_time, sampling frequency, filename)
+                plus 'data bytes', the size of the data section, and 
+                'columns', the names of the columns in the chunks.
+            chunks: generator of dicts of columns, like parse's. 
+                Comments are forward filled across chunks.
+        """
+    seprator = '\t'
+    if is_dataset(filename):
+        return iter_dataset(filename, grab_from=grab_from, offset=offset, 
+            exclusions=exclusions, columns=columns, dtype=dtype, 
+            blocksize=blocksize, lines=lines, rows=rows, window=window)
+    f = getfile(filename, mode='rb')
+    header = read_header(f, header_lines, header_scheme, output=output,
+        separator=seprator)
+    stop = find_rows(f, header['delta_x'], lines=lines, grab_from=grab_from,
+        offset=offset, rows=rows, window=window, index=index)
+    start = f.tell()
+    f.seek(0, 2)
+    header['data bytes'] = (f.tell() if stop is None else stop) - start
+    f.seek(start)
+    header['filename'] = f.name
+    if columns is not None:
+        exclusions = []
+    reader = BlockParser(header['column_titles'], separator=seprator, 
+        keep_comments='Comment' not in exclusions, dtype=dtype, 
+        columns=columns, delta_x=header['delta_x'] if synthesize_x else None)
+    header['columns'] = [k for k in reader.keys() if k not in exclusions]
+
+    def chunks():
+        try:
+            for block in iter_blocks(f, blocksize, stop=stop):
+                columns = reader.parse_block(block)
+                yield {k: columns[k] for k in columns if k not in exclusions}
+        finally:
+            f.close()
+    return header, chunks()
+
+
+def parse_dataset(path, lines=None, grab_from='front', offset=0,
+    exclusions=['Comment'], columns=None, dtype=np.float64, rows=None,
+    window=None):
+    """ parse for a dataset made by dataset.convert. the same rows are 
+        picked as parse would pick from the lvm file, as views of the 
+        memory mapped columns (so nothing is read until it's used). 
+        columns of another dtype are converted, which reads them.
+        """
+    meta, data = load_dataset(path, columns=columns)
+    lo, hi = dataset_rows(path, meta, lines, grab_from, offset, rows, window)
+    if columns is not None:
+        exclusions = []
+    to_ret = {k: dataset_column(data[k][lo:hi], dtype) for k in data 
+        if k not in exclusions}
+    to_ret.update({k: meta['header'][k] for k in ('numcols', 'delta_x', 
+        'start_time', 'sampling frequency')})
+    to_ret['filename'] = path
+    return to_ret
 
-    for i,col in enumerate(column_titles):
-        columns[col] = [] # initialize a list to hold the column
-        columns_map[col] = i # remember what index the column is
-    columns['manual_particle_detector'] = [] 
-        # assuming the datafile contains the manual patricle detector button.
-        # which is recorded within the comment.  
 
-    # === read the file =============
-    for i,l in enumerate(datalines):
-        dataline_split = l.strip().split(seprator)
-        # if this row has no comment, get it from the previous line
-        if len(dataline_split) != num_cols:
-            dataline_split.append(columns['Comment'][-1])
-
-        for k in columns:
-            if k == 'manual_particle_detector':
-                particle_present = dataline_split[-1].split(',')[-1]
-                columns[k].append(particle_present)
+def iter_dataset(path, grab_from='front', offset=0, exclusions=['Comment'], 
+    columns=None, dtype=np.float64, blocksize=BLOCK_SIZE, lines=None, 
+    rows=None, window=None):
+    """ iter_parse for a dataset made by dataset.convert. chunks are 
+        about blocksize bytes of the columns.
+        """
+    meta, data = load_dataset(path, columns=columns)
+    lo, hi = dataset_rows(path, meta, lines, grab_from, offset, rows, window)
+    if columns is not None:
+        exclusions = []
+    data = {k: data[k] for k in data if k not in exclusions}
+    header = dict(meta['header'])
+    row_bytes = sum(v.itemsize for v in data.values()) or 1
+    header['data bytes'] = (hi - lo) * row_bytes
+    header['filename'] = path
+    header['columns'] = list(data)
+    step = max(blocksize // row_bytes, 1)
+
+    def chunks():
+        for first in range(lo, hi, step):
+            yield {k: dataset_column(v[first:min(first + step, hi)], dtype) 
+                for k, v in data.items()}
+    return header, chunks()
+
+
+def dataset_rows(path, meta, lines=None, grab_from='front', offset=0, 
+    rows=None, window=None):
+    """ the (first, stop) rows of a dataset wanted, like find_rows """
+    total = meta['rows']
+    if window is not None:
+        x0 = float(load_dataset(path, ['X_Value'])[1]['X_Value'][0]) \
+            if total and 'X_Value' in meta['columns'] else 0.
+        row_at = lambda t: max(int(np.ceil((t - x0) / 
+            meta['header']['delta_x'] - 1e-9)), 0)
+        rows = (row_at(window[0]), None if window[1] is None else 
+            row_at(window[1]))
+    elif rows is None and grab_from == 'back':
+        rows = (total - offset - (total if lines is None else lines), 
+            total - offset)
+    elif rows is None:
+        rows = (offset, None if lines is None else offset + lines)
+    first, stop = rows
+    first = min(max(first, 0), total)
+    stop = total if stop is None else min(max(stop, first), total)
+    return first, stop
+
+
+def dataset_column(column, dtype):
+    """ the column as dtype, without a copy if it is already """
+    if column.dtype.kind == 'f' and column.dtype != np.dtype(dtype):
+        return column.astype(dtype)
+    return column
+
+
+def find_rows(f, delta_x=None, lines=None, grab_from='front', offset=0, 
+    rows=None, window=None, index=True):
+    """ moves the open (binary) file f, which is just past the header, to 
+        the first row wanted. returns the byte the rows wanted end at, or 
+        None for the end of the file. 
+        The rows wanted are, in order of precedence
+            window: (start, stop) seconds (like X_Value), stop can be None
+            rows: (first, stop) row numbers, stop can be None
+            lines & offset: from the front or the back (grab_from)
+        Any but the whole file are found with the LineIndex, which is 
+        saved in the index directory (True for the default, False not to 
+        save it).
+        """
+    if window is None and rows is None and not offset and lines is None:
+        return None # everything
+    lines_index = LineIndex(f.name, f.tell(), 
+        directory=None if index is True else index)
+    if window is not None:
+        rows = (lines_index.row_at(window[0], delta_x), None 
+            if window[1] is None else lines_index.row_at(window[1], delta_x))
+    elif rows is None and grab_from == 'back':
+        total = lines_index.rows()
+        rows = (max(total - offset - (total if lines is None else lines), 0), 
+            max(total - offset, 0))
+    elif rows is None:
+        rows = (offset, None if lines is None else offset + lines)
+    first, last = rows
+    stop = None
+    if last is not None:
+        lines_index.seek(f, max(last, first))
+        stop = f.tell()
+    lines_index.seek(f, first)
+    return stop
+
+
+def iter_blocks(f, blocksize=BLOCK_SIZE, stop=None):
+    """ Reads the rest of an (binary) file object in large chunks.
+        Each yielded chunk ends on a newline, so no row is ever split 
+        between two chunks. The leftover partial line is carried over 
+        to the next chunk. A final line without a newline is left out, it 
+        is still being written (like follow.Follower does).
+        stop: byte offset to stop reading at, None for the end of the file
+        """
+    rest = b''
+    while True:
+        size = blocksize if stop is None else min(blocksize, stop - f.tell())
+        if size <= 0:
+            break
+        chunk = f.read(size)
+        if not chunk:
+            break
+        chunk = rest + chunk
+        cut = chunk.rfind(b'\n') + 1
+        rest = chunk[cut:]
+        if cut:
+            yield chunk[:cut]
+
+
+def split_ranges(f, blocksize=BLOCK_SIZE, stop=None):
+    """ splits the rest of an open (binary) file (up to byte stop) into 
+        newline-aligned byte ranges of about blocksize bytes. 
+        returns a list of (start, stop). f is left where it was.
+        """
+    start = f.tell()
+    f.seek(0, 2)
+    size = f.tell() if stop is None else min(stop, f.tell())
+    bounds = [start]
+    for pos in range(start + blocksize, size, blocksize):
+        if pos <= bounds[-1]:
+            continue
+        f.seek(pos - 1)
+        f.readline() # to the end of the line pos - 1 is on
+        if f.tell() >= size:
+            break
+        bounds.append(f.tell())
+    bounds.append(size)
+    f.seek(start)
+    return [(a, b) for a, b in zip(bounds[:-1], bounds[1:]) if b > a]
+
+
+def parse_parallel(f, reader, workers=None, blocksize=BLOCK_SIZE, stop=None):
+    """ reader.parse_blocks(iter_blocks(f)), on a pool of processes.
+
+        The rest of the file is split into newline-aligned byte ranges 
+        (split_ranges). The rows of every range are estimated from the 
+        length of the lines at the start of the file, and the columns are
+        allocated in shared memory with a slot for every range, a little 
+        bigger than the estimate. Every worker reads and parses a range 
+        once and writes its rows straight into its slot. The parent then 
+        moves the slots together and trims the columns to the rows found 
+        (a range that doesn't fit its slot is handed back instead, and the 
+        columns are put together from the pieces). The comments are handed
+        back to the parent, which forward fills them over the whole file, 
+        so a range starting before its first comment gets the last comment 
+        of the ranges before it.
+
+        args    -> f: an open binary file, at the first line to parse.
+                -> reader: a BlockParser, it is copied to the workers.
+                -> workers: number of processes. None for the cpu count.
+                -> blocksize: about the bytes of one range
+                -> stop: byte to stop at, None for the end of the file
+        returns the columns, like BlockParser.parse_blocks
+        """
+    ranges = split_ranges(f, blocksize, stop)
+    if len(ranges) < 2 or workers == 1:
+        return reader.parse_blocks(iter_blocks(f, blocksize, stop))
+
+    sample = f.read(min(SAMPLE_SIZE, ranges[0][1] - ranges[0][0]))
+    per_byte = max(sample.count(b'\n'), 1) / float(len(sample))
+    sizes = [int((b - a) * per_byte * SLACK) + 16 for a, b in ranges]
+    slots = np.concatenate(([0], np.cumsum(sizes)))
+
+    itemsize = np.dtype(reader.dtype).itemsize
+    shared = {t: RawArray(ctypes.c_char, int(slots[-1]) * itemsize) 
+        for t in reader.parsed_titles}
+    pool = multiprocessing.Pool(workers, initializer=_init_worker,
+        initargs=(f.name, reader, shared))
+    try:
+        tasks = [(a, b, int(slot), size) 
+            for (a, b), slot, size in zip(ranges, slots, sizes)]
+        found = pool.map(_parse_range, tasks)
+    finally:
+        pool.close()
+        pool.join()
+    f.seek(0, 2)
+
+    counts = [n for _, n, _, _, _ in found]
+    firsts = np.concatenate(([0], np.cumsum(counts)))
+    rows = int(firsts[-1])
+    columns = {}
+    for i, t in enumerate(reader.parsed_titles):
+        column = np.frombuffer(shared[t], dtype=reader.dtype)
+        if any(values is not None for _, _, values, _, _ in found):
+            column = np.concatenate([column[slot:slot + n] if values is None 
+                else values[:, i] for slot, (_, n, values, _, _) in 
+                zip(slots, found)])
+        else: # in place, every slot starts at or after where it goes
+            for slot, first, n in zip(slots, firsts, counts):
+                if slot != first:
+                    column[first:first + n] = column[slot:slot + n]
+        columns[t] = column[:rows]
+    if reader.delta_x is not None:
+        reader.x0 = next((x0 for x0, _, _, _, _ in found if x0 is not None), 
+            None)
+        columns['X_Value'] = (reader.x0 + reader.delta_x * 
+            np.arange(rows)).astype(reader.dtype, copy=False)
+    comment_rows = np.concatenate([r + first for (_, _, _, r, _), first in 
+        zip(found, firsts)])
+    comments = [c for _, _, _, _, cs in found for c in cs]
+    columns.update(reader.fill_comments(rows, comment_rows, comments))
+    reader.rows += rows
+    return {k: columns[k] for k in reader.keys()}
+
+
+_worker = {} # the state of a parse_parallel worker process
+
+def _init_worker(filename, reader, shared):
+    _worker['file'] = open(filename, 'rb')
+    _worker['reader'] = reader
+    _worker['columns'] = {t: np.frombuffer(shared[t], dtype=reader.dtype) 
+        for t in shared}
+
+
+def _read_range(start, stop):
+    f = _worker['file']
+    f.seek(start)
+    block = f.read(stop - start)
+    # the end of the file, a last line without a newline is still being
+    # written. left out like iter_blocks does
+    return block[:block.rfind(b'\n') + 1]
+
+
+def _parse_range(task):
+    """ parses a range into its slot of the columns. returns x0, the rows,
+        the values if they didn't fit (else None), and the comment rows 
+        (from the start of the range) & comments.
+        """
+    start, stop, slot, size = task
+    reader = _worker['reader']
+    reader.x0 = None
+    values, comment_rows, comments = reader.tokenize(_read_range(start, stop))
+    if len(values) > size:
+        return reader.x0, len(values), values, comment_rows, comments
+    for i, t in enumerate(reader.parsed_titles):
+        _worker['columns'][t][slot:slot + len(values)] = values[:, i]
+    return reader.x0, len(values), None, comment_rows, comments
+
+
+class BlockParser(object):
+    """ Turns newline-aligned blocks of the tab seperated data section
+        straight into typed numpy columns. 
+
+        Instead of splitting each line in python, each block is handled as 
+        one array of bytes:
+            1. newlines and tabs are located with numpy, giving the number 
+               of fields on every row.
+            2. rows with one extra field carry a comment. The comment text is 
+               sliced out (they are sparse) and then blanked in the buffer,
+               along with the fields of the columns that aren't wanted.
+            3. what is left is pure numbers, converted in one C call 
+               (numpy.fromstring) and reshaped into rows x numeric columns.
+            4. the comment column is forward filled with an index array 
+               (maximum.accumulate), manual_particle_detector is the last 
+               comma seperated field of each distinct comment.
+
+        The parser remembers the last comment it saw (and the number of 
+        rows) so successive blocks can be fed one after another. 
+
+        args    -> column_titles: list of column names from the header.
+                    the comment column, if any, must be the last one.
+                -> separator: defaults to tab
+                -> keep_comments: build the (string) Comment column. 
+                -> dtype: numpy dtype of the numeric columns 
+                -> columns: the columns wanted (numeric titles, 
+                    'manual_particle_detector', 'Comment'). None for all 
+                    of them. The others are blanked before the numbers are
+                    converted, and the comments are only looked at if 
+                    manual_particle_detector or Comment is wanted.
+                -> delta_x: if given, X_Value is worked out from the first
+                    row's X_Value and delta_x instead of being parsed.
+        """
+    def __init__(self, column_titles, separator='\t', keep_comments=True,
+        dtype=np.float64, columns=None, delta_x=None):
+        self.column_titles = list(column_titles)
+        self.separator = ord(separator)
+        self.has_comment = bool(self.column_titles) and \
+            self.column_titles[-1] == 'Comment'
+        if self.has_comment:
+            self.numeric_titles = self.column_titles[:-1]
+        else:
+            self.numeric_titles = self.column_titles
+        if columns is not None:
+            unknown = set(columns) - set(self.numeric_titles) - \
+                set(['manual_particle_detector', 'Comment'] 
+                if self.has_comment else [])
+            if unknown:
+                raise ValueError('No column(s) {} in {}'.format(
+                    ', '.join(sorted(unknown)), self.column_titles))
+        wanted = lambda t: columns is None or t in columns
+        self.keep_comments = keep_comments and self.has_comment and \
+            wanted('Comment')
+        self.detector = self.has_comment and \
+            wanted('manual_particle_detector')
+        self.delta_x = delta_x if wanted('X_Value') and \
+            'X_Value' in self.numeric_titles else None
+        # the numeric columns that get converted
+        self.parsed_titles = [t for t in self.numeric_titles if wanted(t) 
+            and not (t == 'X_Value' and self.delta_x is not None)]
+        # runs of neighbouring columns that are blanked, (first, last) index
+        self.dropped = []
+        for i, t in enumerate(self.numeric_titles):
+            if t in self.parsed_titles:
+                continue
+            if self.dropped and self.dropped[-1][1] == i - 1:
+                self.dropped[-1] = (self.dropped[-1][0], i)
             else:
-                columns[k].append(dataline_split[columns_map[k]])
-            if k != 'Comment':
-                columns[k][-1] = float(columns[k][-1]) # convert to float
-
-    for k in columns:
-        columns[k] = np.array(columns[k])
-
-    f.close() # we have read the file. close it now.
-
-    # ============
-    # Return stuff
-    # ============
-    to_ret = {k:columns[k] for k in columns if k not in exclusions}
-    to_ret['numcols'] = num_cols
-    to_ret['delta_x'] = delta_x
-    to_ret['start_time'] = start_time
-    to_ret['sampling frequency'] = sampling_freq
-    to_ret['filename'] = filename
-
-    if output: print(prettify(to_ret))
-    return to_ret
+                self.dropped.append((i, i))
+        self.dtype = dtype
+        self.last_comment = None # carried across blocks
+        self.rows = 0 # rows parsed so far
+        self.x0 = None # X_Value of the first row
+
+    def parse_block(self, block):
+        """ returns a dict of columns for one newline-aligned block """
+        values, comment_rows, comments = self.tokenize(block)
+        columns = {t: values[:, i] for i, t in enumerate(self.parsed_titles)}
+        if self.delta_x is not None:
+            columns['X_Value'] = (self.x0 + self.delta_x * 
+                np.arange(self.rows, self.rows + len(values))).astype(
+                self.dtype, copy=False)
+        self.rows += len(values)
+        columns.update(self.fill_comments(len(values), comment_rows, 
+            comments))
+        return columns
+
+    def lines(self, block):
+        """ returns the bytes of a newline-aligned block as a uint8 array,
+            and the starts & ends (the newline) of its rows. 
+            blank lines are left out.
+            """
+        numcols = len(self.numeric_titles)
+        buf = np.frombuffer(block, dtype=np.uint8)
+        ends = np.flatnonzero(buf == NEWLINE)
+        starts = np.concatenate(([0], ends[:-1] + 1))[:len(ends)]
+
+        # drop blank lines, they would otherwise count as empty rows.
+        # a real row is at least numcols digits and the seprators between them
+        short = np.flatnonzero(ends - starts < 2 * numcols - 1)
+        blank = [i for i in short if not block[starts[i]:ends[i]].strip()]
+        if blank:
+            starts, ends = np.delete(starts, blank), np.delete(ends, blank)
+        return buf, starts, ends
+
+    def tokenize(self, block):
+        """ the numbers & comments of one newline-aligned block.
+            returns values (rows x the parsed numeric columns), 
+            comment_rows (the row of every comment) and comments (their 
+            text). the comments are only read if they're wanted.
+            """
+        numcols = len(self.numeric_titles)
+        buf, starts, ends = self.lines(block)
+
+        # === find the rows that carry a comment ===
+        seps = np.flatnonzero(buf == self.separator)
+        seps_before_start = np.searchsorted(seps, starts)
+        seps_per_row = np.searchsorted(seps, ends) - seps_before_start
+
+        comment_rows = np.empty(0, dtype=np.intp)
+        comments = []
+        firsts, lasts = [], [] # byte ranges that are blanked
+        if self.has_comment:
+            candidates = np.flatnonzero(seps_per_row >= numcols)
+            if len(candidates):
+                # the comment starts at the numcols'th seprator of the row
+                first = seps[seps_before_start[candidates] + numcols - 1]
+                last = ends[candidates]
+                if self.detector or self.keep_comments:
+                    texts = [block[s + 1:e].decode('latin-1').strip() 
+                        for s, e in zip(first, last)]
+                    filled = np.array([bool(t) for t in texts], dtype=bool)
+                    comment_rows = candidates[filled]
+                    comments = [t for t in texts if t]
+                # blank out the comments (and their seprators) so only 
+                # numbers are left. 
+                firsts.append(first)
+                lasts.append(last)
+
+        # === blank the columns that aren't wanted ===
+        if self.x0 is None and len(ends) and self.delta_x is not None:
+            i = self.numeric_titles.index('X_Value')
+            self.x0 = float(block[starts[0] if i == 0 else 
+                seps[seps_before_start[0] + i - 1] + 1:
+                seps[seps_before_start[0] + i] if i < numcols - 1 or 
+                seps_per_row[0] >= numcols else ends[0]])
+        for a, b in self.dropped:
+            firsts.append(starts if a == 0 else 
+                seps[seps_before_start + a - 1] + 1)
+            # the last column runs to the comment or the end of the line
+            lasts.append(ends if b == numcols - 1 else 
+                seps[seps_before_start + b])
+
+        work = buf
+        if firsts:
+            # indexes of every byte in [first, last)
+            first, last = np.concatenate(firsts), np.concatenate(lasts)
+            lengths = last - first
+            offsets = np.repeat(first - np.cumsum(lengths) + lengths, 
+                lengths)
+            work = buf.copy()
+            work[offsets + np.arange(lengths.sum())] = SPACE
+
+        # === numbers ===
+        wanted = len(self.parsed_titles)
+        values = np.fromstring(work.tobytes(), dtype=self.dtype, sep=' ') \
+            if wanted else np.empty(0, dtype=self.dtype)
+        if values.size != len(ends) * wanted:
+            raise ValueError('Expected {} rows of {} numeric columns. '
+                'Found {} values'.format(len(ends), wanted, values.size))
+        return values.reshape(len(ends), wanted), comment_rows, comments
+
+    def fill_comments(self, rows, comment_rows, comments):
+        """ forward fills comments (found at comment_rows) over rows, 
+            starting with the last comment of the previous block. 
+            returns a dict with manual_particle_detector and/or Comment,
+            whichever is wanted.
+            """
+        if not (self.detector or self.keep_comments):
+            return {}
+        # index 0 is the comment carried over from the last block
+        distinct = [self.last_comment] + list(comments)
+        which = np.zeros(rows, dtype=np.intp)
+        which[comment_rows] = np.arange(1, len(comment_rows) + 1)
+        which = np.maximum.accumulate(which)
+
+        columns = {}
+        if self.detector:
+            flags = np.array([detector_flag(c) for c in distinct])
+            columns['manual_particle_detector'] = flags[which]
+        if self.keep_comments:
+            text = np.array(['' if c is None else c for c in distinct])
+            columns['Comment'] = text[which]
+        self.last_comment = distinct[-1]
+        return columns
+
+    def keys(self):
+        """ the names of the columns parse_block returns """
+        keys = [t for t in self.numeric_titles if t in self.parsed_titles or 
+            (t == 'X_Value' and self.delta_x is not None)]
+        if self.detector:
+            keys.append('manual_particle_detector')
+        if self.keep_comments:
+            keys.append('Comment')
+        return keys
+
+    def parse_blocks(self, blocks):
+        """ parses every block and concatenates the columns """
+        parsed = [self.parse_block(b) for b in blocks]
+        keys = self.keys()
+        if not parsed:
+            return {k: np.empty(0, dtype=str if k == 'Comment' else 
+                self.dtype) for k in keys}
+        return {k: np.concatenate([p[k] for p in parsed]) for k in keys}
+
+
+def detector_flag(comment):
+    """ the manual particle detector button is recorded as the last comma 
+        seperated field of the comment. returns it as a float, or nan if 
+        there is no comment (yet) or it isn't a number.
+        """
+    if comment is None:
+        return np.nan
+    try:
+        return float(comment.split(',')[-1])
+    except ValueError:
+        return np.nan
 
 
 
-def tail(n, filename=None, offset=0, output=True): # returns the last n lines of the file. 
+def tail(n, filename=None, offset=0, output=True, f=None, 
+    blocksize=TAIL_BLOCK_SIZE): # returns the last n lines of the file. 
     """ This grabs the last N lines from a file. 
         if filename is unspecified you'll be prompted for a file.
 
-        this is kind of interesting. we're running the shell command:
-        `tail -n n filename` if your os doesn't support tail then this may not work.
-        I developed this on linux and updated it on windows 7.  
+        The file is read backwards from the end in blocks of blocksize bytes
+        until N + offset lines have been seen, so only the bytes that are 
+        needed (plus at most one block) are ever read or held in memory. 
+        It doesn't matter how big the file is.
+
+        args    -> n: number of lines to return
+                -> filename: file to read. opened in binary mode
+                -> offset: skip this many lines from the back
+                -> f: an already open binary file object. lines before its
+                    current position (i.e. the header) are never returned.
+                    it is left open.
+        returns a list of lines (bytes), in file order. every line ends 
+            with a newline, a last line without one is still being written
+            and is left out (like iter_blocks does).
         """
-    if filename is None:
-        filename = getfile(filename, o=False)
-    filename = '\'' + filename + '\''
-    string = "tail -n " + str(n + offset) + " " + filename 
-    if output: print(string)
-    stdin,stdout = os.popen2(str(string))
-    lines = stdout.readlines()
-    stdin.close()
-    stdout.close()
-    return lines[:lines.__len__() - offset]
-
-
-def getfile(filename, o=True): # Manages opening the datafile to parse 
+    close = f is None
+    if f is None:
+        f = getfile(filename, mode='rb')
+    start = 0 if close else f.tell() # don't read back into the header
+
+    wanted = n + offset
+    f.seek(0, 2) # seek to the end
+    pos = f.tell()
+    if output: print('tail: {} lines from byte {}'.format(wanted, pos))
+
+    chunks = []
+    found = 0 # newlines seen so far
+    # one newline more than we want, so the first line is always complete
+    while pos > start and found <= wanted:
+        size = min(blocksize, pos - start)
+        pos -= size
+        f.seek(pos)
+        chunk = f.read(size)
+        found += chunk.count(b'\n')
+        chunks.append(chunk)
+    if close:
+        f.close()
+
+    lines = b''.join(reversed(chunks)).splitlines(True)
+    if pos > start:
+        lines = lines[1:] # a partial line from the middle of a block
+    if lines and not lines[-1].endswith(b'\n'): 
+        lines = lines[:-1] # still being written
+    lines = lines[-wanted:] if wanted else []
+    return lines[:max(len(lines) - offset, 0)]
+
+
+def getfile(filename, o=True, mode='r'): # Manages opening the datafile to parse 
     '''
         returns a file object or raises noFileException with text 
         describing the cause
         o: True/False, if true returns file object, else filename
+        mode: passed through to open. parse reads the file as bytes ('rb')
 
         if filename is None:
             opens up a gui to prompt the user for a filename
@@ -204,14 +874,33 @@ def getfile(filename, o=True): # Manages opening the datafile to parse
     '''
     if filename is None:
         filename = askopenfilename()
-    if filename is None:
+    if not filename:
         raise noFileException('No File selected')
+    if not o:
+        return filename
 
     try:
-        f = open(filename)
+        f = open(filename, mode)
         return f
     except Exception as e:
         raise noFileException('Exception while trying to open {}. \
             Error: {}'.format(filename, e))
 
-Tk().withdraw()
\ No newline at end of file
+
+def askopenfilename():
+    ''' prompts for a file with a tk dialog. returns the filename, or an 
+        empty string if the dialog was cancelled.
+        Tk is only imported here, so nothing else needs a display.
+    '''
+    try:
+        from Tkinter import Tk 
+        from tkFileDialog import askopenfilename as ask
+    except ImportError: # python 3
+        from tkinter import Tk
+        from tkinter.filedialog import askopenfilename as ask
+    root = Tk()
+    root.withdraw() # no main window, just the dialog
+    try:
+        return ask()
+    finally:
+        root.destroy()
@@ -5,7 +5,11 @@
 
 
 import sys
-from numpy import NaN, Inf, arange, isscalar, asarray, array
+from numpy import nan, inf, arange, isscalar, asarray, array, flatnonzero, \
+    fmax, fmin, isnan, ones, sign, diff, count_nonzero, float64
+
+MIN_WINDOW = 64 # smallest number of samples scanned with one array operation
+SPARSE = 64 # turning points per large swing above which peaks count as sparse
 
 def peakdet(v, delta, x = None):
     """
@@ -30,10 +34,196 @@ def peakdet(v, delta, x = None):
     
     % Eli Billauer, 3.4.05 (Explicitly not copyrighted).
     % This function is released to the public domain; Any use is allowed.
-    
+
+    The scan is done by PeakDetector, which gives exactly the same result 
+    as the original element by element loop (peakdet_loop) using array 
+    operations.
     """
-    print('v',v)
-    print('x',x)
+    if x is not None and len(v) != len(x):
+        sys.exit('Input vectors v and x must have same length')
+    return PeakDetector(delta).update(v, x)
+
+
+class PeakDetector(object):
+    """ peakdet, one chunk at a time. 
+
+        The state of the hysteresis (the running max/min and their 
+        positions, and whether we're looking for a max or a min) is kept 
+        between calls to update, so feeding a signal in successive chunks 
+        finds exactly the same peaks as feeding it all at once.
+
+        Each chunk is first reduced to its turning points with array 
+        operations: nans, repeated values and the inside of monotonic runs 
+        never change the state of the hysteresis, so only the first sample 
+        of every local max/min (and the ends of the chunk) are kept. 
+        On a smoothed signal that is a small fraction of the samples.
+
+        The turning points are then scanned in one of two ways:
+            - sparse peaks: windows of the signal are searched at once. 
+              fmax.accumulate gives the running max (or min) and the first 
+              sample that drops delta below it is where the next peak is 
+              confirmed. The window then restarts just after it, so the 
+              number of array operations is about the number of peaks.
+            - dense peaks: the array calls would cost more than the samples,
+              so the turning points are walked as plain python floats.
+        Both give exactly the same result as the original loop.
+
+        args    -> delta: hysteresis. must be a positive scalar. 
+        """
+    def __init__(self, delta):
+        if not isscalar(delta):
+            sys.exit('Input argument delta must be a scalar')
+        if delta <= 0:
+            sys.exit('Input argument delta must be positive')
+        self.delta = delta
+        self.mn, self.mx = inf, -inf
+        self.mnpos, self.mxpos = nan, nan
+        self.lookformax = True
+        self.samples = 0 # samples seen so far. the default x positions.
+
+    def update(self, v, x = None):
+        """ scans the next chunk of the signal
+            v : values 
+            x : their positions. defaults to the sample number, counted 
+                from the first chunk
+            returns maxtab, mintab of the peaks confirmed within this chunk.
+            """
+        v = asarray(v)
+        if x is None:
+            x = arange(self.samples, self.samples + len(v))
+        else:
+            x = asarray(x)
+        if len(v) != len(x):
+            sys.exit('Input vectors v and x must have same length')
+        self.samples += len(v)
+
+        keep = turning_points(v)
+        v, x = v[keep], x[keep]
+        # python floats are only exact stand ins for 64 bit values
+        exact = v.dtype == float64 or v.dtype.kind in 'biu'
+        swings = count_nonzero(abs(diff(v)) > self.delta) if len(v) else 0
+        if exact and len(v) < SPARSE * (swings + 1):
+            maxtab, mintab = self._walk(v, x)
+        else:
+            maxtab, mintab = self._scan(v, x)
+        return array(maxtab), array(mintab)
+
+    def _scan(self, v, x):
+        """ finds the peaks a window at a time with array operations """
+        maxtab = []
+        mintab = []
+        delta = self.delta
+        i, n = 0, len(v)
+        window = MIN_WINDOW
+        while i < n:
+            seg = v[i:i + window]
+            if self.lookformax:
+                run = fmax(fmax.accumulate(seg), self.mx)
+                hits = flatnonzero(seg < run - delta)
+            else:
+                run = fmin(fmin.accumulate(seg), self.mn)
+                hits = flatnonzero(seg > run + delta)
+
+            if not len(hits): 
+                # no peak in this window. remember the extremes & move on.
+                self._track_max(seg, x[i:i + window])
+                self._track_min(seg, x[i:i + window])
+                i += len(seg)
+                window *= 2
+                continue
+
+            k = hits[0]
+            if self.lookformax:
+                self._track_max(seg[:k + 1], x[i:i + k + 1])
+                maxtab.append((self.mxpos, self.mx))
+                self.mn = v[i + k]
+                self.mnpos = x[i + k]
+                self.lookformax = False
+            else:
+                self._track_min(seg[:k + 1], x[i:i + k + 1])
+                mintab.append((self.mnpos, self.mn))
+                self.mx = v[i + k]
+                self.mxpos = x[i + k]
+                self.lookformax = True
+            i += k + 1
+            window = max(MIN_WINDOW, 2 * (k + 1))
+        return maxtab, mintab
+
+    def _walk(self, v, x):
+        """ the original hysteresis, on python floats """
+        maxtab = []
+        mintab = []
+        delta = self.delta
+        mn, mx = self.mn, self.mx
+        mnpos, mxpos = self.mnpos, self.mxpos
+        lookformax = self.lookformax
+        for this, pos in zip(v.tolist(), x.tolist()):
+            if this > mx:
+                mx = this
+                mxpos = pos
+            if this < mn:
+                mn = this
+                mnpos = pos
+            if lookformax:
+                if this < mx-delta:
+                    maxtab.append((mxpos, mx))
+                    mn = this
+                    mnpos = pos
+                    lookformax = False
+            else:
+                if this > mn+delta:
+                    mintab.append((mnpos, mn))
+                    mx = this
+                    mxpos = pos
+                    lookformax = True
+        self.mn, self.mx = mn, mx
+        self.mnpos, self.mxpos = mnpos, mxpos
+        self.lookformax = lookformax
+        return maxtab, mintab
+
+    def _track_max(self, seg, x):
+        """ raises mx to the largest value in seg. ties keep the first one """
+        if len(seg):
+            top = fmax.reduce(seg) # ignores nan, like the comparisons do
+            if top > self.mx:
+                j = (seg == top).argmax()
+                self.mx = seg[j]
+                self.mxpos = x[j]
+
+    def _track_min(self, seg, x):
+        """ lowers mn to the smallest value in seg. ties keep the first one """
+        if len(seg):
+            bottom = fmin.reduce(seg)
+            if bottom < self.mn:
+                j = (seg == bottom).argmax()
+                self.mn = seg[j]
+                self.mnpos = x[j]
+
+
+def turning_points(v):
+    """ returns the indexes of v that can change the state of peakdet:
+        the first sample of every local max and min, and both ends.
+        nans and the inside of monotonic runs are left out.
+        """
+    idx = flatnonzero(~isnan(v)) if v.dtype.kind == 'f' else arange(len(v))
+    w = v[idx]
+    if len(w) < 3:
+        return idx
+    changed = ones(len(w), dtype=bool) # drop repeats, keep the first one
+    changed[1:] = w[1:] != w[:-1]
+    idx, w = idx[changed], w[changed]
+    if len(w) < 3:
+        return idx
+    slope = sign(diff(w))
+    turn = ones(len(w), dtype=bool)
+    turn[1:-1] = slope[1:] != slope[:-1]
+    return idx[turn]
+
+
+def peakdet_loop(v, delta, x = None):
+    """ The original element by element implementation of peakdet.
+        Kept as the reference PeakDetector is checked against.
+        """
     maxtab = []
     mintab = []
 
@@ -50,10 +240,9 @@ def peakdet(v, delta, x = None):
         sys.exit('Input argument delta must be positive')
        
     v = asarray(v)
-    print('v',v)
     
-    mn, mx = Inf, -Inf
-    mnpos, mxpos = NaN, NaN
+    mn, mx = inf, -inf
+    mnpos, mxpos = nan, nan
     
     lookformax = True
     
@@ -82,6 +271,25 @@ def peakdet(v, delta, x = None):
 
     return array(maxtab), array(mintab)
 
+
+def check(n=100000, delta=.3, chunks=7, seed=0):
+    """ checks peakdet and a chunked PeakDetector against peakdet_loop
+        on a random walk. returns True if they all agree exactly. 
+        """
+    from numpy import random, array_split, concatenate
+    v = random.RandomState(seed).randn(n).cumsum() * .1
+    x = arange(n) * .001
+    expected = peakdet_loop(v, delta, x=x)
+
+    found = [peakdet(v, delta, x=x)]
+    detector = PeakDetector(delta)
+    parts = [detector.update(a, b) for a, b in 
+        zip(array_split(v, chunks), array_split(x, chunks))]
+    found.append(tuple(concatenate([p[t] for p in parts if len(p[t])]) 
+        for t in (0, 1)))
+    return all((e.shape == f.shape and (e == f).all()) 
+        for r in found for e, f in zip(expected, r))
+
 def test():
     from matplotlib.pyplot import plot, scatter, show
     series = [0,0,0,2,0,0,0,-2,0,0,0,2,0,0,0,-2,0]
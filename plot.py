@@ -1,10 +1,26 @@
+'''
+    The summary figure: one panel per series, sharing x.
+
+    plot draws it on screen (and waits for it to be closed). render writes
+    it to a file (.png, .svg, .pdf ...) without a screen: it draws on a bare
+    matplotlib Figure, so no pyplot / gui backend is involved and it works
+    in batch runs and worker processes. RenderPool renders in a pool of 
+    processes, so whoever submits the figure can get on with the next file.
+'''
 import time
+import multiprocessing
+
+from numpy import asarray, arange, concatenate, unique
+from calc import polyfit
+from instrument import log
+# matplotlib is imported where it's used, pyplot only for plot
 
-from matplotlib import pyplot as plt
-from calc import meanarray, maxarray , minarray, polyfit
+FIGSIZE = (12, 9) # inches, of the figures written by render
+DPI = 100
 
-def plot(x, y_list, x_title = 'Time', plot_title = None, measurements=['ave']):
-    """ This plots x vs y. it supports multiple y lists, 
+def plot(x, y_list, x_title = 'Time', plot_title = None, measurements=['ave'],
+    max_points='auto', markers=None):
+    """ This plots x vs y on screen. it supports multiple y lists, 
         but they all must be of the same length. 
         args    -> y_list should be a list of tuples. 
                     [(title, [values]), (title, [values]),...]
@@ -15,11 +31,45 @@ def plot(x, y_list, x_title = 'Time', plot_title = None, measurements=['ave']):
                     - ave  - -
                     - max  ^ / min V
                     - bestfit,deg o
+                -> max_points: most points drawn per line. long series are
+                    cut down to the min & max of each slice (see envelope) 
+                    so every spike is still drawn.
+                    'auto' (default) is two per pixel of the figure's width,
+                    None draws everything.
+                -> markers: dict of {title: (x values, y values)} drawn as 
+                    markers on the plot with that title, never cut down. 
+                    e.g. {'Result': r['particles']}
         """
+    from matplotlib import pyplot as plt
+    log.debug('Plotting : %s', ','.join([y[0] for y in y_list]))
+    plt.ion()   # make plotting interactive
+    draw(plt.figure(), x, y_list, x_title=x_title, plot_title=plot_title, 
+        measurements=measurements, max_points=max_points, markers=markers)
+    plt.show()
 
-    print('Plotting : ', ','.join([y[0] for y in y_list]))
-    # plt.ion()   # make plotting interactive
-    
+
+def render(filename, x, y_list, x_title = 'Time', plot_title = None, 
+    measurements=['ave'], max_points='auto', markers=None, figsize=FIGSIZE, 
+    dpi=DPI):
+    """ plot, written to filename instead of shown. the format is 
+        worked out from the extension (png, svg, pdf ...).
+        figsize (inches) & dpi are those of the file.
+        returns filename
+        """
+    from matplotlib.figure import Figure
+    log.debug('Rendering %s : %s', filename, ','.join([y[0] for y in y_list]))
+    fig = Figure(figsize=figsize, dpi=dpi)
+    draw(fig, x, y_list, x_title=x_title, plot_title=plot_title, 
+        measurements=measurements, max_points=max_points, markers=markers)
+    fig.savefig(filename)
+    return filename
+
+
+def draw(fig, x, y_list, x_title = 'Time', plot_title = None, 
+    measurements=['ave'], max_points='auto', markers=None):
+    """ draws the panels of plot on the matplotlib figure fig. 
+        args are the same as plot. returns fig
+        """
     #CHECK THE ARGS
     # ensure they supplied some y_vals
     assert(y_list)
@@ -35,34 +85,135 @@ def plot(x, y_list, x_title = 'Time', plot_title = None, measurements=['ave']):
 
 
     # plot them!
-    plt.figure() # start a new figure
+    if max_points == 'auto': # 2 points per pixel is all that can be seen
+        max_points = int(2 * fig.get_size_inches()[0] * fig.dpi)
+    keep = envelope(y_list, max_points)
+    all_x = asarray(x)
+    x = all_x[keep]
     if(not plot_title): # set a title, default to current time. 
         plot_title = time.strftime('%d %H:%M')
-    plt.title(plot_title)
+    fig.suptitle(plot_title)
     cur_plot = 1
 
-    print('y_list is: {}'.format(y_list))
     for y in y_list:
         y_title = y[0] # the y title 
-        y_vals = y[1] # the list of y values to be plotted
-        plt.subplot(len(y_list),1,cur_plot) # initialize the plot
-        plt.plot(x,y_vals)  # plot the data
+        y_vals = asarray(y[1]) # the list of y values to be plotted
+        ax = fig.add_subplot(len(y_list),1,cur_plot) # initialize the plot
+        ax.plot(x,y_vals[keep])  # plot the data
         
         for m in measurements: # plot stuff about each plot
-            print(m)
-            if(m is 'ave'): 
-                plt.plot(x, meanarray(y_vals), 'm--')
-            if(m is 'max'): 
-                plt.plot(x, maxarray(y_vals), 'k^')
-            if(m is 'min'): 
-                plt.plot(x, minarray(y_vals), 'kv')
+            # these are worked out on all the data, but drawn at the kept x's
+            if(m == 'ave'): 
+                ax.plot(x, [y_vals.mean()] * len(x), 'm--')
+            if(m == 'max'): 
+                ax.plot(x, [y_vals.max()] * len(x), 'k^')
+            if(m == 'min'): 
+                ax.plot(x, [y_vals.min()] * len(x), 'kv')
             if('bestfit' in m): 
-                deg = m.split(',')[1]
-                plt.plot(x, polyfit(x, y_vals, d=deg), 'mo')
+                deg = int(m.split(',')[1])
+                ax.plot(x, polyfit(all_x, y_vals, d=deg)[keep], 'mo')
+
+        if markers and y_title in markers:
+            mark_x, mark_y = markers[y_title]
+            ax.plot(mark_x, mark_y, 'rx')
 
-        plt.ylabel(y_title)   # set the title. I've had enough of unlabeled charts
+        ax.set_ylabel(y_title)   # set the title. I've had enough of unlabeled charts
         cur_plot = cur_plot +1  # go to the next chart
-    plt.show()
-    
+    ax.set_xlabel(x_title)
+    return fig
+
+
+class RenderPool(object):
+    """ renders figures in a pool of worker processes.
+
+        submit returns at once with a multiprocessing AsyncResult (a 
+        future): .get() waits for the figure and returns its filename (or 
+        raises what went wrong), .ready() says if it's done. Or just forget
+        about it, close waits for everything that was submitted.
 
-plt.ion()
\ No newline at end of file
+        Millions of points would take longer to send to a worker than to 
+        draw, so the series are cut down (see envelope) before they're 
+        sent, to what the file can show anyway.
+
+            with RenderPool() as renderer:
+                for f in files:
+                    ...
+                    renderer.submit(f + '.png', x, y_list, markers=...)
+
+        args    -> workers: processes. 1 by default, drawing is usually 
+                    quicker than the analysis that goes with it.
+        """
+    def __init__(self, workers=1):
+        self.workers = workers
+        self.pool = None # started with the first figure
+
+    def submit(self, filename, x, y_list, **kwargs):
+        """ render(filename, x, y_list, **kwargs) in a worker. 
+            returns its AsyncResult
+            """
+        max_points = kwargs.pop('max_points', 'auto')
+        if max_points == 'auto':
+            max_points = int(2 * kwargs.get('figsize', FIGSIZE)[0] * 
+                kwargs.get('dpi', DPI))
+        # measurements are worked out on every point, those have to go
+        if max_points and not kwargs.get('measurements', ['ave']):
+            keep = envelope(y_list, max_points)
+            x = asarray(x)[keep]
+            y_list = [(title, asarray(values)[keep]) 
+                for title, values in y_list]
+            max_points = None
+        if self.pool is None:
+            self.pool = multiprocessing.Pool(self.workers)
+        kwargs['max_points'] = max_points
+        return self.pool.apply_async(render, (filename, x, y_list), kwargs)
+
+    def close(self):
+        """ waits for the figures submitted & stops the workers """
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def terminate(self):
+        """ stops the workers, dropping the figures not drawn yet """
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def envelope(y_list, max_points):
+    """ Returns the (sorted) indexes of the points worth drawing.
+
+        The series are cut into max_points/2 slices of equal length, and 
+        the min and max of every series in each slice are kept (plus the 
+        first and last points). At screen resolution that draws exactly 
+        what the full data would, spikes included, for a few thousand 
+        points instead of millions.
+
+        y_list is a list of (title, values) like plot takes. all the series
+        share the indexes, so they still line up on the same x.
+        if max_points is None or there are fewer points, everything is kept.
+        """
+    n = len(y_list[0][1])
+    bins = max_points // 2 if max_points else 0
+    if not bins or n <= max_points:
+        return arange(n)
+    per = n // bins # points per slice, the leftovers make one more slice
+    full = per * bins
+    starts = arange(0, full, per)
+    keep = [[0, n - 1]]
+    for y in y_list:
+        y_vals = asarray(y[1])
+        slices = y_vals[:full].reshape(bins, per)
+        keep += [starts + slices.argmin(axis=1), starts + slices.argmax(axis=1)]
+        if full < n:
+            rest = y_vals[full:]
+            keep += [[full + rest.argmin(), full + rest.argmax()]]
+    return unique(concatenate(keep))
@@ -0,0 +1,121 @@
+'''
+    Reading ahead in a background thread.
+
+    process_stream reads a block of the file, then smooths, detrends and
+    scans it, then reads the next block: the disk waits for the cpu and the
+    cpu waits for the disk. A Prefetcher runs the reading (and parsing) of
+    the next blocks in a thread while the current one is worked on, so the
+    whole thing takes about as long as the slower of the two instead of
+    both added up. Reading a file and most numpy operations let go of the
+    GIL, which is what lets them overlap.
+
+    The blocks go through a queue of depth blocks (2 is double buffering,
+    3 triple). When it's full the reader waits for the consumer to take
+    one (backpressure), so no more than depth + 2 blocks are ever in
+    memory however far ahead the reader could get.
+
+    An exception in the reader is raised in the consumer, at the block it
+    would have been. Closing the Prefetcher (or leaving a with block, or
+    an exception in the consumer if it's used that way) stops the reader
+    and closes the iterator it reads from, so the file is closed too.
+'''
+import sys
+import threading
+
+try:
+    from queue import Queue, Full, Empty
+except ImportError: # python 2
+    from Queue import Queue, Full, Empty
+
+POLL = .1 # seconds between checks for a close, while blocked on the queue
+
+# what the reader puts on the queue, with the block or the error
+ITEM, DONE, ERROR = range(3)
+
+
+class Prefetcher(object):
+    """ an iterator over iterable that runs it in a background thread,
+        up to depth items ahead.
+
+            with Prefetcher(chunks, depth=2) as chunks:
+                for c in chunks:
+                    ...
+
+        args    -> iterable: what to read ahead. it's only ever touched by
+                    the reader thread (generators are closed there too).
+                -> depth: items queued up ahead of the consumer
+        """
+    def __init__(self, iterable, depth=2):
+        if depth < 1:
+            raise ValueError('depth must be at least 1, not {}'.format(depth))
+        self.queue = Queue(maxsize=depth)
+        self.stopped = threading.Event()
+        self.finished = False
+        self.thread = threading.Thread(target=self._read,
+            args=(iter(iterable), self.queue, self.stopped),
+            name='anemia_plotter prefetch')
+        self.thread.daemon = True # never keeps the interpreter alive
+        self.thread.start()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.finished:
+            raise StopIteration
+        kind, value = self.queue.get()
+        if kind == ITEM:
+            return value
+        self.close()
+        if kind == ERROR:
+            raise value
+        raise StopIteration
+
+    next = __next__ # python 2
+
+    def close(self):
+        """ stops the reader and waits for it. blocks that were read
+            ahead are dropped.
+            """
+        self.finished = True
+        self.stopped.set()
+        while self.thread.is_alive():
+            try: # make room, in case it's waiting to put one more
+                self.queue.get(timeout=POLL)
+            except Empty:
+                pass
+        self.thread.join()
+
+    def __del__(self): # let the reader go if this was never closed
+        self.stopped.set()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @staticmethod
+    def _read(iterator, queue, stopped):
+        # only gets the queue & the event, not the Prefetcher, so a
+        # forgotten Prefetcher can still be garbage collected
+        def put(message):
+            while not stopped.is_set():
+                try:
+                    queue.put(message, timeout=POLL)
+                    return True
+                except Full:
+                    pass
+            return False
+        try:
+            for item in iterator:
+                if not put((ITEM, item)):
+                    break
+            else:
+                put((DONE, None))
+        except Exception:
+            put((ERROR, sys.exc_info()[1]))
+        finally:
+            close = getattr(iterator, 'close', None)
+            if close is not None:
+                close()
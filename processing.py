@@ -1,8 +1,15 @@
 import utils
+from collections import OrderedDict
 
-from parse_file import parse
-from plot import plot
-from calc import polyfit, find_peaks, mean, moving_average
+from parse_file import parse, iter_parse, BLOCK_SIZE
+from calc import find_peaks, MovingAverage, PolyfitAccumulator, SegmentedFit, \
+    ButterworthFilter, moving_average, polyfit, filter
+from peakdetect import PeakDetector
+from instrument import Instruments
+from prefetch import Prefetcher
+from result import Result, HEADER
+from validate import validate as validate_peaks, SCORES
+from numpy import concatenate, empty, array, stack
 
 
 def process_raw_data(filename = None, 
@@ -12,14 +19,74 @@ def process_raw_data(filename = None,
     delta=.004,
     xlabel='Time (s)',
     title = None,
+    smoothing='binned',
+    stream=False,
+    show_plot=None,
+    figure=None,
+    renderer=None,
+    segment=None,
+    detrend='polyfit',
+    cutoff=.1,
+    causal=None,
+    memory=False,
+    dtype=None,
+    channels=None,
+    validate=False,
+    tolerance=None,
     **kwargs):
     '''
 
         Args:
         =======
         -> maxima T/F deteck peaks as maxima or minima
+        -> binsize: number of points averaged when smoothing the output
+        -> smoothing: how the output is smoothed, see calc.moving_average
+                'binned' (default), 'centered' or 'trailing'
+        -> stream: process the file a block at a time with process_stream.
+                memory no longer depends on the file length, but only the 
+                counts and the peak tables are returned, and nothing is plotted
+                (show_plot, figure, renderer, channels and validate can't 
+                be used with it)
+        -> show_plot: plot the summary graph at the end. 
+                turn it off when running unattended. by default it's 
+                shown unless it's written to a figure.
+        -> figure: write the summary graph to this file instead (.png, 
+                .svg, .pdf ...), without a screen. see plot.render
+        -> renderer: a plot.RenderPool to write the figure in, so this 
+                returns without waiting for it. r['rendering'] is then 
+                the AsyncResult of the figure, .get() waits for it.
+        -> segment: seconds. remove the drift with a separate polynomial for
+                every segment of this length (see calc.SegmentedFit) 
+                instead of one for the whole file. for long runs.
+        -> detrend: how the drift is removed from the smoothed output
+                'polyfit' (default) subtracts a polynomial of degree deg,
+                'highpass' runs a butterworth high pass (calc.filter) 
+                instead, 'both' does one then the other.
+        -> cutoff: Hz. cutoff of the high pass
+        -> causal: run the high pass forwards only, like process_stream 
+                has to. by default it runs both ways so the peaks aren't 
+                shifted (and forwards with stream, causal=False can't be 
+                used with it).
+        -> dtype: float32 to keep the columns (and the series worked out
+                from them) in half the memory. 
+        -> memory: also measure the peak memory of every stage (slower).
+                the wall/cpu time and rows of every stage (parse, smoothing, 
+                detrend, peaks, plot) are always in r['timings'], 
+                see instrument.py
+        -> channels: a list of output columns to process together instead
+                of Voltage_1, see process_channels. 'all' for every 
+                Voltage_ column but the input. 
+                returns a dict of channel -> Result then.
+        -> validate: check the particles against the manual particle 
+                detector (see validate.py). r['hits'], r['misses'], 
+                r['false positives'] ... and all of it in r['validation']
+        -> tolerance: seconds the manual events are widened by when 
+                validating. a bin of the smoothing by default.
         -> label 
 
+        returns a result.Result, which works like the dict this used to 
+        return (r['number of particles'], r['output adjusted'], ...)
+
         This function is the main entry point.
         given a file it will do the whole processing... thing...
         this is mainly just to make it easier.
@@ -28,72 +95,445 @@ def process_raw_data(filename = None,
         If you change acquisition!!! change this!!!!
 
     '''
+    if stream:
+        # none of these are done a block at a time
+        unsupported = [name for name, value in (('show_plot', show_plot), 
+            ('figure', figure), ('renderer', renderer), 
+            ('channels', channels), ('validate', validate), 
+            ('causal=False', causal is False and detrend != 'polyfit')) 
+            if value]
+        if unsupported:
+            raise ValueError('{} can not be used with stream=True'.format(
+                ', '.join(unsupported)))
+        if dtype is not None: # parse straight into it
+            kwargs.setdefault('dtype', dtype)
+        return process_stream(filename=filename, maxima=maxima, 
+            binsize=binsize, deg=deg, delta=delta, smoothing=smoothing, 
+            segment=segment, detrend=detrend, cutoff=cutoff, memory=memory,
+            **kwargs)
+    if channels is not None:
+        return process_channels(filename=filename, 
+            channels=None if channels == 'all' else channels, maxima=maxima,
+            binsize=binsize, deg=deg, delta=delta, xlabel=xlabel, title=title,
+            smoothing=smoothing, show_plot=show_plot, figure=figure, 
+            renderer=renderer, segment=segment, detrend=detrend, 
+            cutoff=cutoff, causal=causal, memory=memory, dtype=dtype, 
+            validate=validate, tolerance=tolerance, **kwargs)
+    if detrend not in ('polyfit', 'highpass', 'both'):
+        raise ValueError('Unknown detrend {}'.format(detrend))
+    instruments = Instruments(memory=memory)
+
     # ASSUMPTIONS!!!!!! change these. there may be more subtle assumptions
     # further in. 
-    inputV = 'Voltage_0'    # input signal, to track phase changes
-    outputV = 'Voltage_1'   # output signal, to track particles
-    x = 'X_Value'           # time array, 
+    inputV = Result.INPUT   # input signal, to track phase changes
+    outputV = Result.OUTPUT # output signal, to track particles
+    x = Result.TIME         # time array, 
 
-    r = parse(filename=filename, **kwargs) # parse the datafile
-    assert(inputV in r) # __ASSUMPTIONS__ we know this to be the input signal
-    assert(outputV in r) # __ASSUMPTIONS__ we know this to be the output signal
+    if dtype is not None: # parse straight into it
+        kwargs.setdefault('dtype', dtype)
+    with instruments.stage('parse') as current:
+        parsed = parse(filename=filename, **kwargs) # parse the datafile
+        current['rows'] = len(parsed[x])
+    assert(inputV in parsed) # __ASSUMPTIONS__ we know this to be the input signal
+    assert(outputV in parsed) # __ASSUMPTIONS__ we know this to be the output signal
 
-
-    # add some useful info 
-
-    r['input ave'] = [mean(r[inputV])] * len(r[inputV])
-    r['output ave'] = [mean(r[outputV])] * len(r[outputV])
+    # the means & the settings go in with the columns. 
+    r = Result({k: parsed[k] for k in parsed if k not in HEADER}, parsed, 
+        dtype=dtype, binsize=binsize, smoothing=smoothing, deg=deg, 
+        segment=segment, detrend=detrend, cutoff=cutoff, causal=causal, 
+        maxima=maxima, delta=delta)
+    del parsed
+    rows = r.rows
 
     # =============================
     ''' Smooth the output to remove large peaks resulting from rare noise events '''
-    r['smoothed output'] = moving_average(r[outputV], n=binsize)
-    r['bin size'] = binsize
+    with instruments.stage('smoothing', rows):
+        smoothed = r.smoothed()
     
     # =============================
     ''' remove instrumental drift. By fitting a polynomial to the 
-        output signal, then subtracting it. '''
-    r['polyfit to output'] = polyfit(r[x],r[outputV], d=deg)
-    r['deg'] = deg
-
-    r['output adjusted'] = r['smoothed output'] - r['polyfit to output']
-
+        output signal, then subtracting it. and/or by high pass filtering'''
+    with instruments.stage('detrend', rows):
+        adjusted = r.adjusted(smoothed=smoothed)
 
     # ==============================
     ''' Run the detect peak algorithm to count the peaks in the datafile. '''
-    mx, mn = find_peaks(r[x], r['output adjusted'], delta=delta)
-    if maxima: 
-        r['particles'] = mx
-        r['number of particles'] = len(mx)
-    else: 
-        r['particles'] = mn 
-        r['number of particles'] = len(mn)
-    r['max'] = maxima
-    r['delta'] = delta
+    with instruments.stage('peaks', rows):
+        mx, mn = find_peaks(r[x], adjusted, delta=delta)
+    r.particles = mx if maxima else mn
 
+    if validate:
+        with instruments.stage('validate', r.number_of_particles):
+            r['validation'] = validate_peaks(r, tolerance)
+        for k in SCORES:
+            r[k] = r['validation'][k]
 
     # =============================
     ''' The hard part is done. just plot the results. 
         I want to produce one summary graph. that displays the processing pipeline
         and one that is just the results. 
     '''
-    plots = [
-        ('Raw Output', r[outputV]),
-        ('Smoothed Output', r['smoothed output']),
-        ('Result', r['output adjusted'])
-    ]
-    plot(r[x], plots, x_title=xlabel, plot_title=title, measurements=[])
+    if show_plot is None:
+        show_plot = figure is None
+    if show_plot or figure is not None:
+        plots = [
+            ('Raw Output', r[outputV]),
+            ('Smoothed Output', smoothed),
+            ('Result', adjusted)
+        ]
+        markers = {'Result': r.particles} if r.number_of_particles else None
+        with instruments.stage('plot', rows):
+            _summary(r, r[x], plots, markers, xlabel, title, show_plot, figure,
+                renderer)
 
     # =============================
     # and we're done. return the results just for goodness sake. 
+    # the series are worked out again if they're asked for (see result.py)
+    r.timings = instruments.finish()
     return r 
 
 
 
+def process_channels(filename = None,
+    channels = None,
+    maxima = None,
+    binsize=20,
+    deg=3,
+    delta=.004,
+    xlabel='Time (s)',
+    title = None,
+    smoothing='binned',
+    show_plot=None,
+    figure=None,
+    renderer=None,
+    segment=None,
+    detrend='polyfit',
+    cutoff=.1,
+    causal=False,
+    memory=False,
+    dtype=None,
+    validate=False,
+    tolerance=None,
+    **kwargs):
+    '''
+        process_raw_data for several output channels at once.
+
+        The channels are parsed once and stacked into one 2d array (a row 
+        per channel), which is smoothed, detrended and filtered as a whole:
+        every step is one set of array operations for all the channels 
+        (the polyfit basis is worked out once and shared, see 
+        calc.polyfit). Only the peak detection, which is a scan, goes 
+        through the channels one at a time.
+
+        Args are the same as process_raw_data, plus
+        -> channels: the columns to process. defaults to every Voltage_ 
+                column but the input (Voltage_0), in the order of the file.
+
+        returns a dict of channel -> result.Result, in the order of 
+        channels. Each is the same as process_raw_data would return for that
+        channel (r['channel'] is its name). They share the parsed columns 
+        and r['timings'], which covers all of the channels.
+    '''
+    if detrend not in ('polyfit', 'highpass', 'both'):
+        raise ValueError('Unknown detrend {}'.format(detrend))
+    instruments = Instruments(memory=memory)
+    x = Result.TIME
+
+    if dtype is not None: # parse straight into it
+        kwargs.setdefault('dtype', dtype)
+    with instruments.stage('parse') as current:
+        parsed = parse(filename=filename, **kwargs)
+        current['rows'] = len(parsed[x])
+    if channels is None:
+        channels = [k for k in parsed if k.startswith('Voltage_') and 
+            k != Result.INPUT]
+    missing = [c for c in channels if c not in parsed]
+    if missing:
+        raise ValueError('No channel(s) {} in {}'.format(', '.join(missing), 
+            parsed['filename']))
+
+    # the channels are held once, in the 2d array. the rest is shared.
+    with instruments.stage('stack', len(parsed[x]) * len(channels)):
+        stacked = stack([parsed[c] for c in channels])
+        if dtype is not None:
+            stacked = stacked.astype(dtype, copy=False)
+    shared = {k: parsed[k] for k in parsed if k not in HEADER and 
+        k not in channels}
+    results = OrderedDict()
+    for i, c in enumerate(channels):
+        columns = dict(shared)
+        columns[c] = stacked[i]
+        results[c] = Result(columns, parsed, dtype=dtype, binsize=binsize, 
+            smoothing=smoothing, deg=deg, segment=segment, detrend=detrend, 
+            cutoff=cutoff, causal=causal, maxima=maxima, delta=delta, 
+            output=c)
+    fs = parsed['sampling frequency']
+    del parsed
+    t = shared[x]
+    work = len(t) * len(channels)
+
+    # the same steps as process_raw_data, for every channel at once
+    with instruments.stage('smoothing', work):
+        smoothed = moving_average(stacked, n=binsize, mode=smoothing, 
+            dtype=dtype)
+    with instruments.stage('detrend', work):
+        adjusted = smoothed
+        if detrend != 'highpass':
+            adjusted = adjusted - polyfit(t, stacked, d=deg, segment=segment)
+        if detrend != 'polyfit':
+            adjusted = filter(adjusted, cutoff=cutoff, fs=fs, causal=causal)
+        if dtype is not None:
+            adjusted = adjusted.astype(dtype, copy=False)
+    with instruments.stage('peaks', work):
+        for i, c in enumerate(channels):
+            mx, mn = find_peaks(t, adjusted[i], delta=delta)
+            results[c].particles = mx if maxima else mn
+    if validate: # every channel against the same manual detector
+        with instruments.stage('validate', sum(r.number_of_particles
+            for r in results.values())):
+            for r in results.values():
+                r['validation'] = validate_peaks(r, tolerance)
+                for k in SCORES:
+                    r[k] = r['validation'][k]
 
+    if show_plot is None:
+        show_plot = figure is None
+    if channels and (show_plot or figure is not None):
+        plots = [(c, adjusted[i]) for i, c in enumerate(channels)]
+        markers = {c: r.particles for c, r in results.items() 
+            if r.number_of_particles}
+        with instruments.stage('plot', work):
+            _summary(list(results.values()), t, plots, markers or None, 
+                xlabel, title, show_plot, figure, renderer)
 
-process_raw_data()
+    timings = instruments.finish()
+    for r in results.values():
+        r.timings = timings
+    return results
 
 
 
+def _summary(results, x, plots, markers, xlabel, title, show_plot, figure, 
+    renderer):
+    ''' shows and/or writes the summary graph, as process_raw_data's 
+        show_plot, figure & renderer say. 
+        the figure & its rendering go into the result(s).
+    '''
+    settings = {'x_title': xlabel, 'plot_title': title, 'measurements': [],
+        'markers': markers}
+    rendering = None
+    if figure is not None and renderer is not None:
+        rendering = renderer.submit(figure, x, plots, **settings)
+    elif figure is not None:
+        from plot import render # matplotlib is only loaded when plotting
+        render(figure, x, plots, **settings)
+    for r in results if isinstance(results, list) else [results]:
+        if figure is not None:
+            r['figure'] = figure
+            r['rendering'] = rendering
+    if show_plot:
+        from plot import plot
+        plot(x, plots, **settings)
+
+
+
+def process_stream(filename = None,
+    maxima = None,
+    binsize=20,
+    deg=3,
+    delta=.004,
+    smoothing='binned',
+    segment=None,
+    detrend='polyfit',
+    cutoff=.1,
+    blocksize=BLOCK_SIZE,
+    memory=False,
+    prefetch=2,
+    **kwargs):
+    '''
+        process_raw_data for files that don't fit in memory.
+
+        The file is read twice, one block (blocksize bytes) at a time:
+            1. the polynomial fit to the output is built up from every block 
+               (calc.PolyfitAccumulator), along with the input/output means.
+            2. each block is smoothed (calc.MovingAverage), has the fit 
+               subtracted and goes through the peak detection 
+               (peakdetect.PeakDetector). Bins and peaks that straddle two
+               blocks are carried over, so the particles found are the same 
+               as process_raw_data's.
+        Only a few blocks and the peaks found are ever held in memory.
+        The next blocks are read (and parsed) in a background thread while
+        one is being worked on, see prefetch.py. 'parse' in r['timings'] 
+        is then the time spent waiting for them.
+        A high pass (detrend='highpass' or 'both') is always causal here, 
+        it runs forwards one block at a time (calc.ButterworthFilter).
+
+        Args are the same as process_raw_data, plus
+        -> blocksize: bytes of the file per block. 16MB by default
+        -> prefetch: blocks read ahead, 2 by default. 0 reads each block
+                when it's needed, in this thread.
+
+        returns a dict with the counts and peak tables, the settings and the
+        header info. 'input ave' and 'output ave' are plain numbers, 
+        r['stream'] is True.
+    '''
+    inputV = 'Voltage_0'    # input signal, to track phase changes
+    outputV = 'Voltage_1'   # output signal, to track particles
+    x = 'X_Value'           # time array, 
+    if detrend not in ('polyfit', 'highpass', 'both'):
+        raise ValueError('Unknown detrend {}'.format(detrend))
+    instruments = Instruments(memory=memory)
+    rows_of = lambda c: len(c[x])
+    # only these are used, the rest (comments too) isn't worth parsing
+    kwargs.setdefault('columns', [x, inputV, outputV])
+
+    def read(): # the blocks of the file, read ahead if prefetch
+        header, chunks = iter_parse(filename=filename, blocksize=blocksize, 
+            **kwargs)
+        return header, Prefetcher(chunks, prefetch) if prefetch else chunks
+
+    # === pass 1: polyfit & means =================
+    header, reader = read()
+    # rough middle & half width of the time axis, to keep the fit well 
+    # conditioned. rows are estimated from the size of the first block.
+    fit = None
+    rows = 0
+    input_sum = output_sum = 0.
+    try:
+        for c in instruments.iterate('parse', reader, rows_of):
+            assert(inputV in c) # __ASSUMPTIONS__ we know this to be the input signal
+            assert(outputV in c) # __ASSUMPTIONS__ we know this to be the output signal
+            if fit is None and len(c[x]) and segment:
+                fit = SegmentedFit(d=deg, length=segment, origin=c[x][0])
+            elif fit is None and len(c[x]):
+                expected = header['data bytes'] / float(blocksize) * len(c[x])
+                half = max(expected, len(c[x])) * header['delta_x'] / 2.
+                fit = PolyfitAccumulator(d=deg, center=c[x][0] + half, 
+                    scale=half)
+            if len(c[x]) and detrend != 'highpass':
+                with instruments.stage('detrend', len(c[x])):
+                    fit.update(c[x], c[outputV])
+            rows += len(c[x])
+            input_sum += c[inputV].sum()
+            output_sum += c[outputV].sum()
+    finally: # stops the reader if anything went wrong
+        reader.close()
+
+    if detrend == 'highpass':
+        fit = None
+    elif fit is None: # no data at all
+        fit = PolyfitAccumulator(d=deg)
+    highpass = None
+    if detrend != 'polyfit':
+        highpass = ButterworthFilter(cutoff=cutoff, 
+            fs=header['sampling frequency'])
+
+    # === pass 2: smooth, detrend, find peaks =====
+    kwargs['output'] = False # the header was printed already
+    header, reader = read()
+    stage = OutputStream(fit, binsize=binsize, smoothing=smoothing, 
+        delta=delta, highpass=highpass, instruments=instruments)
+    maxtabs, mintabs = [], []
+
+    def collect(found): # keep the peaks, let go of the signal
+        if len(found['maxtab']): maxtabs.append(found['maxtab'])
+        if len(found['mintab']): mintabs.append(found['mintab'])
+
+    try:
+        for c in instruments.iterate('parse', reader, rows_of):
+            collect(stage.update(c[x], c[outputV]))
+    finally:
+        reader.close()
+    collect(stage.flush())
+
+    # transposed, like find_peaks returns them
+    mx = (concatenate(maxtabs) if maxtabs else array([])).T
+    mn = (concatenate(mintabs) if mintabs else array([])).T
+
+    # ============
+    # Return stuff
+    # ============
+    r = {k: header[k] for k in ('numcols', 'delta_x', 'start_time', 
+        'sampling frequency', 'filename')}
+    r['rows'] = rows
+    r['input ave'] = input_sum / rows if rows else float('nan')
+    r['output ave'] = output_sum / rows if rows else float('nan')
+    r['bin size'] = binsize
+    r['smoothing'] = smoothing
+    r['deg'] = deg
+    r['segment'] = segment
+    r['detrend'] = detrend
+    r['cutoff'] = cutoff if detrend != 'polyfit' else None
+    r['stream'] = True
+    if maxima: 
+        r['particles'] = mx
+        r['number of particles'] = len(mx.T)
+    else: 
+        r['particles'] = mn
+        r['number of particles'] = len(mn.T)
+    r['max'] = maxima
+    r['delta'] = delta
+    r['timings'] = instruments.finish()
+    return r
+
+
+
+class OutputStream(object):
+    '''
+        The smoothing, drift removal and peak detection steps of 
+        process_raw_data, for an output signal that comes in chunks.
+
+        update takes the next chunk of times & output values. The smoother 
+        holds back samples whose bin/window isn't complete yet (their times 
+        are held back with them); the rest are detrended with fit and go 
+        through the peak detection, which carries its state over.
+
+        Args:
+        =======
+        -> fit: a calc.PolyfitAccumulator. it is only evaluated here, 
+                whoever owns it decides what goes into it. 
+                None to not subtract a fit.
+        -> highpass: a calc.ButterworthFilter run after the fit is 
+                subtracted, or None
+        -> binsize, smoothing, delta: as process_raw_data
+        -> instruments: an instrument.Instruments the smoothing, detrend 
+                and peaks stages are timed into. 
+    '''
+    def __init__(self, fit, binsize=20, smoothing='binned', delta=.004,
+        highpass=None, instruments=None):
+        self.fit = fit
+        self.highpass = highpass
+        self.instruments = instruments or Instruments()
+        self.smoother = MovingAverage(n=binsize, mode=smoothing)
+        self.detector = PeakDetector(delta)
+        self.times = empty(0) # x of the samples the smoother is holding back
+
+    def update(self, x, y):
+        ''' returns a dict of what's final so far: 
+            x, smoothed, adjusted (smoothed - fit), and maxtab/mintab of 
+            the peaks confirmed.
+        '''
+        self.times = concatenate((self.times, x))
+        with self.instruments.stage('smoothing', len(y)):
+            smoothed = self.smoother.update(y)
+        return self._detect(smoothed)
 
+    def flush(self):
+        ''' same as update, for whatever is left at the end '''
+        with self.instruments.stage('smoothing'):
+            smoothed = self.smoother.flush()
+        return self._detect(smoothed)
 
+    def _detect(self, smoothed):
+        t = self.times[:len(smoothed)]
+        self.times = self.times[len(smoothed):]
+        with self.instruments.stage('detrend', len(t)):
+            adjusted = smoothed
+            if self.fit is not None:
+                adjusted = adjusted - self.fit.evaluate(t)
+            if self.highpass is not None:
+                adjusted = self.highpass.update(adjusted)
+        with self.instruments.stage('peaks', len(t)):
+            mx, mn = self.detector.update(adjusted, t)
+        return {'x': t, 'smoothed': smoothed, 'adjusted': adjusted, 
+            'maxtab': mx, 'mintab': mn}
@@ -0,0 +1,183 @@
+'''
+    What process_raw_data returns.
+
+    It used to be a plain dict holding the parsed columns, two lists of
+    the input/output means repeated for every row, and full copies of the
+    signal after every step (smoothed, polyfit, adjusted). For a long file
+    most of that memory was spent on things that are cheap to work out
+    again. A Result keeps
+        the parsed columns (optionally as float32)
+        the header info, the settings and the scalars as they are
+        the particles found
+    and works out the series on access:
+        'input ave', 'output ave'   read only arrays of the mean, they
+                                    take no memory whatever their length
+        'smoothed output', 'polyfit to output', 'output adjusted'
+                                    computed again on every access, keep a
+                                    reference if you need one twice.
+
+    It still behaves like the old dict: r['Voltage_1'], 'deg' in r,
+    r.keys(), r.get(...), dict(r) ... and anything else can be stored in it
+    with r[key] = value.
+
+    The output is Voltage_1 unless it's made for another channel 
+    (processing.process_channels makes one per channel), r['channel'] 
+    says which.
+'''
+from numpy import asarray, broadcast_to
+
+from calc import moving_average, polyfit, filter
+
+HEADER = ('numcols', 'delta_x', 'start_time', 'sampling frequency', 'filename')
+# key -> attribute, for the settings & results that are stored as is
+ATTRIBUTES = {'bin size': 'binsize', 'smoothing': 'smoothing', 'deg': 'deg',
+    'segment': 'segment', 'detrend': 'detrend', 'cutoff': 'cutoff',
+    'causal': 'causal', 'max': 'maxima', 'delta': 'delta',
+    'particles': 'particles', 'timings': 'timings', 'channel': 'output'}
+# key -> method, for the series worked out on access
+SERIES = {'input ave': 'input_average', 'output ave': 'output_average',
+    'smoothed output': 'smoothed', 'polyfit to output': 'fit',
+    'output adjusted': 'adjusted'}
+
+
+class Result(object):
+    """ The result of process_raw_data, see the top of result.py
+
+        args    -> columns: the parsed columns (dict of arrays)
+                -> header: dict with the HEADER info from parse
+                -> dtype: dtype the columns & series are kept in,
+                    None leaves them as parsed (float64).
+                -> output: the column of the output signal
+                -> the settings process_raw_data was called with
+        """
+    __slots__ = ('columns', 'header', 'dtype', 'binsize', 'smoothing', 'deg',
+        'segment', 'detrend', 'cutoff', 'causal', 'maxima', 'delta',
+        'particles', 'timings', 'input_ave', 'output_ave', 'output', 'extra')
+
+    INPUT = 'Voltage_0'  # input signal, to track phase changes
+    OUTPUT = 'Voltage_1' # output signal, to track particles
+    TIME = 'X_Value'     # time array
+
+    def __init__(self, columns, header, dtype=None, binsize=20,
+        smoothing='binned', deg=3, segment=None, detrend='polyfit',
+        cutoff=None, causal=False, maxima=None, delta=.004, output=None):
+        if dtype is not None:
+            columns = {k: asarray(v).astype(dtype, copy=False)
+                if asarray(v).dtype.kind == 'f' else v
+                for k, v in columns.items()}
+        self.columns = columns
+        self.output = output or self.OUTPUT
+        self.header = {k: header[k] for k in HEADER if k in header}
+        self.dtype = dtype
+        self.binsize = binsize
+        self.smoothing = smoothing
+        self.deg = deg
+        self.segment = segment
+        self.detrend = detrend
+        self.cutoff = cutoff if detrend != 'polyfit' else None
+        self.causal = causal
+        self.maxima = maxima
+        self.delta = delta
+        self.particles = None
+        self.timings = None
+        self.input_ave = self.columns[self.INPUT].mean(dtype='f8') \
+            if len(self.columns.get(self.INPUT, ())) else float('nan')
+        self.output_ave = self.columns[self.output].mean(dtype='f8') \
+            if len(self.columns[self.output]) else float('nan')
+        self.extra = {}
+
+    # =============
+    # the series
+    # =============
+    def input_average(self):
+        return broadcast_to(self.input_ave, self.rows)
+
+    def output_average(self):
+        return broadcast_to(self.output_ave, self.rows)
+
+    def smoothed(self):
+        """ the output smoothed, see calc.moving_average """
+        return moving_average(self.columns[self.output], n=self.binsize,
+            mode=self.smoothing, dtype=self.dtype)
+
+    def fit(self):
+        """ the polynomial fit to the output. None if detrend is 'highpass'
+            """
+        if self.detrend == 'highpass':
+            return None
+        fit = polyfit(self.columns[self.TIME], self.columns[self.output],
+            d=self.deg, segment=self.segment)
+        return fit.astype(self.dtype) if self.dtype is not None else fit
+
+    def adjusted(self, smoothed=None, fit=None):
+        """ the smoothed output with the drift taken out. pass smoothed &
+            fit if you have them already.
+            """
+        adjusted = self.smoothed() if smoothed is None else smoothed
+        if self.detrend != 'highpass':
+            adjusted = adjusted - (self.fit() if fit is None else fit)
+        if self.detrend != 'polyfit':
+            adjusted = filter(adjusted, cutoff=self.cutoff,
+                fs=self.header['sampling frequency'], causal=self.causal)
+        if self.dtype is not None:
+            adjusted = adjusted.astype(self.dtype, copy=False)
+        return adjusted
+
+    @property
+    def rows(self):
+        return len(self.columns[self.TIME])
+
+    @property
+    def number_of_particles(self):
+        return len(self.particles.T) if self.particles is not None else 0
+
+    # ==================
+    # dict style access
+    # ==================
+    def keys(self):
+        keys = list(self.columns) + list(self.header) + list(ATTRIBUTES) + \
+            [k for k in SERIES if k != 'polyfit to output' or
+            self.detrend != 'highpass'] + ['number of particles', 'rows']
+        return keys + [k for k in self.extra if k not in keys]
+
+    def __getitem__(self, key):
+        if key in self.extra:
+            return self.extra[key]
+        if key in self.columns:
+            return self.columns[key]
+        if key in self.header:
+            return self.header[key]
+        if key in ATTRIBUTES:
+            return getattr(self, ATTRIBUTES[key])
+        if key in SERIES and key in self:
+            return getattr(self, SERIES[key])()
+        if key == 'number of particles':
+            return self.number_of_particles
+        if key == 'rows':
+            return self.rows
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key in ATTRIBUTES:
+            setattr(self, ATTRIBUTES[key], value)
+        else: # stored values win over the computed ones
+            self.extra[key] = value
+
+    def __contains__(self, key):
+        return key in self.keys()
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def items(self):
+        return [(k, self[k]) for k in self.keys()]
+
+    def __repr__(self):
+        return '<Result {} rows {}, {} particles>'.format(
+            self.header.get('filename'), self.rows, self.number_of_particles)
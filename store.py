@@ -0,0 +1,276 @@
+'''
+    A results store: the particle counts & peak tables of every run, in a
+    local sqlite database (~/.anemia_plotter/results.sqlite by default).
+
+    process_raw_data only returns its results, so comparing hundreds of
+    runs meant processing them all again. A ResultStore keeps, per file
+    and settings
+        runs    the settings (delta, binsize, deg, maxima, smoothing,
+                segment, detrend, cutoff, causal, stream, validate,
+                tolerance), the header info, the number of rows &
+                particles, the scores if it was validated (see
+                validate.py), the fingerprint of the file (see
+                cache.fingerprint) and when it was processed
+        peaks   the time & value of every particle found
+    with indexes on the file, its start time and the settings, so queries
+    across runs are answered from the indexes.
+
+    A file is stored once per settings, storing it again replaces it.
+    batch (--store) skips the files that are stored with the same settings
+    and fingerprint already.
+
+        store = ResultStore()
+        store.add(process_raw_data('run.lvm', show_plot=False))
+        store.runs(delta=.004, binsize=20)  -> list of dicts
+        store.peaks(run['id'])              -> like r['particles']
+'''
+import os
+import json
+import time
+import sqlite3
+
+from numpy import array
+
+from cache import fingerprint
+from validate import SCORES
+
+DEFAULT_PATH = os.path.join(os.path.expanduser('~'), '.anemia_plotter',
+    'results.sqlite')
+
+# settings (process_raw_data's names) -> (result key, default)
+PARAMS = {
+    'delta': ('delta', .004),
+    'binsize': ('bin size', 20),
+    'deg': ('deg', 3),
+    'maxima': ('max', None),
+    'smoothing': ('smoothing', 'binned'),
+    'segment': ('segment', None),
+    'detrend': ('detrend', 'polyfit'),
+    'cutoff': ('cutoff', .1),
+    'causal': ('causal', False),
+    'stream': ('stream', False),
+    'validate': ('validate', False),
+    'tolerance': ('tolerance', None),
+}
+# header info -> column of runs
+HEADER = {'start_time': 'start_time', 'delta_x': 'delta_x',
+    'sampling frequency': 'sampling_frequency', 'numcols': 'numcols'}
+# validate.SCORES -> column of runs
+SCORE_COLUMNS = {k: k.replace(' ', '_') for k in SCORES}
+# columns that came after the first version, added to older databases
+ADDED = [('causal', 'INTEGER'), ('stream', 'INTEGER'),
+    ('validate', 'INTEGER'), ('tolerance', 'REAL'), ('events', 'INTEGER'),
+    ('hits', 'INTEGER'), ('misses', 'INTEGER'),
+    ('false_positives', 'INTEGER'), ('mean_offset', 'REAL')]
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    filename TEXT NOT NULL,
+    params TEXT NOT NULL,
+    fingerprint TEXT NOT NULL,
+    processed REAL NOT NULL,
+    delta REAL, binsize INTEGER, deg INTEGER, maxima INTEGER,
+    smoothing TEXT, segment REAL, detrend TEXT, cutoff REAL,
+    causal INTEGER, stream INTEGER, validate INTEGER, tolerance REAL,
+    events INTEGER, hits INTEGER, misses INTEGER, false_positives INTEGER,
+    mean_offset REAL,
+    start_time TEXT, delta_x REAL, sampling_frequency REAL, numcols INTEGER,
+    rows INTEGER, particles INTEGER,
+    UNIQUE (filename, params)
+);
+CREATE INDEX IF NOT EXISTS runs_start_time ON runs (start_time);
+CREATE INDEX IF NOT EXISTS runs_processed ON runs (processed);
+CREATE INDEX IF NOT EXISTS runs_params ON runs (delta, binsize, deg, maxima);
+CREATE TABLE IF NOT EXISTS peaks (
+    run INTEGER NOT NULL REFERENCES runs (id),
+    time REAL,
+    value REAL
+);
+CREATE INDEX IF NOT EXISTS peaks_run ON peaks (run, time);
+'''
+
+
+def params(settings=None, **more):
+    """ the settings that make a run, with the defaults of process_raw_data
+        filled in, as stored. settings are process_raw_data's keyword args,
+        anything that isn't one of the PARAMS is left out.
+        """
+    settings = dict(settings or {}, **more)
+    found = {k: settings.get(k, default) for k, (_, default) in PARAMS.items()}
+    for k in ('maxima', 'stream', 'validate'):
+        found[k] = bool(found[k])
+    if found['stream']:
+        found['causal'] = True # the high pass always is, streamed
+    if found['detrend'] == 'polyfit':
+        found['cutoff'] = found['causal'] = None # not used
+    else:
+        found['causal'] = bool(found['causal'])
+    if not found['validate']:
+        found['tolerance'] = None
+    return found
+
+
+class ResultStore(object):
+    """ The results of runs, in an sqlite database. see the top of store.py
+
+        args    -> path: the database file, created if it isn't there.
+                    defaults to ~/.anemia_plotter/results.sqlite
+        """
+    def __init__(self, path=None):
+        self.path = path or DEFAULT_PATH
+        directory = os.path.dirname(os.path.abspath(self.path))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.db = sqlite3.connect(self.path, timeout=60)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute('PRAGMA journal_mode=WAL') # readers don't block
+        self.db.executescript(SCHEMA)
+        columns = [row[1] for row in 
+            self.db.execute('PRAGMA table_info(runs)')]
+        with self.db:
+            for column, kind in ADDED:
+                if column not in columns:
+                    self.db.execute('ALTER TABLE runs ADD COLUMN {} {}'.format(
+                        column, kind))
+
+    def has(self, filename, settings=None, current=None):
+        """ True if filename is stored with these settings (process_raw_data
+            keyword args) and hasn't changed since.
+            current: the fingerprint of the file, if you have it
+            """
+        found = self.db.execute('SELECT fingerprint FROM runs '
+            'WHERE filename = ? AND params = ?', (os.path.abspath(filename),
+            self._key(params(settings)))).fetchone()
+        if found is None:
+            return False
+        try:
+            current = current or fingerprint(filename)
+        except OSError:
+            return False
+        return json.loads(found[0]) == current
+
+    def add(self, r, settings=None, particles=None, current=None):
+        """ stores a run, replacing the one with the same file & settings.
+
+            args    -> r: what process_raw_data (or process_stream) returned,
+                        or a batch summary row
+                    -> settings: the process_raw_data keyword args it ran
+                        with. worked out from r by default.
+                    -> particles: the peak table, r['particles'] by default
+                    -> current: the fingerprint of the file when it was
+                        processed. taken now by default.
+            returns the id of the run
+            """
+        if settings is None:
+            settings = {k: r[key] for k, (key, _) in PARAMS.items() if key in r}
+            if 'validation' in r:
+                tolerance = r['validation']['tolerance']
+                if tolerance == r['bin size'] * r['delta_x']:
+                    tolerance = None # the default, keyed like batch & has do
+                settings.update(validate=True, tolerance=tolerance)
+        run = params(settings)
+        filename = os.path.abspath(r['filename'])
+        particles = r['particles'] if particles is None else particles
+        peaks = array(particles, dtype=float).reshape(2, -1) \
+            if len(particles) else array([[], []])
+        values = {
+            'filename': filename,
+            'params': self._key(run),
+            'fingerprint': json.dumps(current or fingerprint(filename)),
+            'processed': time.time(),
+            'rows': r.get('rows'),
+            'particles': peaks.shape[1],
+        }
+        values.update(run)
+        values.update({column: r.get(k) for k, column in HEADER.items()})
+        values.update({column: r.get(k) for k, column in SCORE_COLUMNS.items()})
+        with self.db: # one transaction
+            old = self.db.execute('SELECT id FROM runs WHERE filename = ? AND '
+                'params = ?', (filename, values['params'])).fetchone()
+            if old is not None:
+                self.db.execute('DELETE FROM peaks WHERE run = ?', (old[0],))
+                self.db.execute('DELETE FROM runs WHERE id = ?', (old[0],))
+            names = sorted(values)
+            run_id = self.db.execute('INSERT INTO runs ({}) VALUES ({})'.format(
+                ', '.join(names), ', '.join('?' * len(names))),
+                [values[k] for k in names]).lastrowid
+            self.db.executemany('INSERT INTO peaks (run, time, value) '
+                'VALUES (?, ?, ?)', ((run_id, t, v) for t, v in
+                zip(peaks[0].tolist(), peaks[1].tolist())))
+        return run_id
+
+    def runs(self, filename=None, since=None, **settings):
+        """ the stored runs, as dicts of the columns of runs, oldest first.
+
+            args    -> filename: only the runs of this file
+                    -> since: only runs processed since (unix time)
+                    -> settings: only runs with these settings (delta=.004,
+                        binsize=20 ...), the others can be anything
+            """
+        where, args = [], []
+        if filename is not None:
+            where.append('filename = ?')
+            args.append(os.path.abspath(filename))
+        if since is not None:
+            where.append('processed >= ?')
+            args.append(since)
+        for k, v in sorted(settings.items()):
+            if k not in PARAMS:
+                raise ValueError('Unknown setting {}'.format(k))
+            if k in ('maxima', 'stream', 'validate'):
+                v = bool(v)
+            where.append('{} IS ?'.format(k))
+            args.append(v)
+        sql = 'SELECT * FROM runs'
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        return [dict(row) for row in
+            self.db.execute(sql + ' ORDER BY processed, id', args)]
+
+    def peaks(self, run):
+        """ the peak table of a run (by id), transposed like find_peaks
+            returns it: peaks[0] are the times, peaks[1] the values
+            """
+        cursor = self.db.cursor()
+        cursor.row_factory = None # plain tuples, much quicker than Rows
+        found = cursor.execute('SELECT time, value FROM peaks WHERE run = ? '
+            'ORDER BY time', (run,)).fetchall()
+        return array(found, dtype=float).reshape(-1, 2).T
+
+    def forget(self, filename):
+        """ removes every run of filename """
+        filename = os.path.abspath(filename)
+        with self.db:
+            self.db.execute('DELETE FROM peaks WHERE run IN '
+                '(SELECT id FROM runs WHERE filename = ?)', (filename,))
+            self.db.execute('DELETE FROM runs WHERE filename = ?', (filename,))
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @staticmethod
+    def _key(run):
+        return json.dumps(run, sort_keys=True)
+
+
+def get_store(store):
+    """ turns the store argument of batch into a ResultStore (or None)
+        -> None/False : no store
+        -> True : the default database
+        -> a string : the database at that path
+        -> a ResultStore : used as is
+        """
+    if store is None or store is False:
+        return None
+    if store is True:
+        return ResultStore()
+    if isinstance(store, ResultStore):
+        return store
+    return ResultStore(path=store)
@@ -0,0 +1,203 @@
+'''
+    Parameter sweeps: particle counts for a grid of binsize/deg/delta.
+
+        python -m anemia_plotter sweep <file.lvm> --binsize 10 20 40 \
+            --deg 2 3 --delta .002 .004 .008 [-o sweep.csv]
+
+    Calling process_raw_data for every combination parses the file and
+    redoes the smoothing and the polyfit every time. Here the pipeline is
+    a chain of cached stages
+        parsed -> smoothed(binsize) -> detrended(binsize, deg) -> peaks(delta)
+    (the polyfit only depends on deg, so it's shared by every binsize).
+    Every intermediate is computed once per sweep, and kept by the Sweep
+    so a later run with more grid points only computes what's new.
+    The independent branches (one per binsize, deg pair) run in a pool of
+    threads; numpy does the heavy lifting without holding the GIL.
+
+    With --validate every combination is also scored against the manual
+    particle detector (hits, misses, false positives, see validate.py), to
+    pick the settings that agree with it best.
+'''
+import sys
+import csv
+import json
+import argparse
+from itertools import product
+from multiprocessing.pool import ThreadPool
+
+from parse_file import parse
+from calc import moving_average, polyfit, find_peaks
+from validate import DETECTOR, SCORES, manual_events, match
+
+# table columns, in order.
+FIELDS = ['binsize', 'deg', 'delta', 'number of particles']
+
+
+class Sweep(object):
+    """ The cached stages of the pipeline for one file.
+
+        args    -> filename: the lvm file
+                -> maxima, smoothing, segment: as process_raw_data.
+                    fixed for the whole sweep.
+                -> workers: threads the branches run on. None for the
+                    number of cpus.
+                -> validate: score every combination against the manual 
+                    particle detector, see validate.py
+                -> tolerance: seconds, for validate. a bin of the smoothing
+                    (of each binsize) by default.
+                -> anything else goes to parse (output, cache, ...)
+        """
+    def __init__(self, filename, maxima=None, smoothing='binned',
+        segment=None, workers=None, validate=False, tolerance=None, 
+        **kwargs):
+        self.filename = filename
+        self.maxima = maxima
+        self.smoothing = smoothing
+        self.segment = segment
+        self.workers = workers
+        self.validate = validate
+        self.tolerance = tolerance
+        self.kwargs = kwargs
+        self.kwargs.setdefault('columns', ['X_Value', 'Voltage_1'] + 
+            ([DETECTOR] if validate else []))
+        self.parsed = None
+        self.events = None # starts, ends of the manual events
+        self.smoothed = {} # binsize -> smoothed output
+        self.fits = {}     # deg -> polyfit to the output
+        self.peaks = {}    # (binsize, deg, delta) -> particles
+        self.scores = {}   # (binsize, deg, delta) -> validate.match
+
+    def run(self, binsizes=(20,), degs=(3,), deltas=(.004,)):
+        """ returns the table of particle counts, a list of dicts with the
+            FIELDS, one per combination, sorted by binsize, deg, delta.
+            and the validate.SCORES if validating.
+            """
+        if self.parsed is None:
+            self.parsed = parse(filename=self.filename, **self.kwargs)
+        if self.validate and self.events is None:
+            self.events = manual_events(self.parsed['X_Value'], 
+                self.parsed[DETECTOR])
+        binsizes, degs, deltas = sorted(set(binsizes)), sorted(set(degs)), \
+            sorted(set(deltas))
+        pool = ThreadPool(self.workers)
+        try:
+            # stage 2: smoothing & the fits, all independent of each other
+            todo = [('smoothed', b) for b in binsizes if b not in self.smoothed]
+            todo += [('fits', d) for d in degs if d not in self.fits]
+            for (stage, key), value in zip(todo, pool.map(self._stage, todo)):
+                getattr(self, stage)[key] = value
+            # stage 3: a branch per (binsize, deg), peaks for every delta
+            branches = [(b, d, [e for e in deltas if (b, d, e) not in self.peaks])
+                for b, d in product(binsizes, degs)]
+            branches = [branch for branch in branches if branch[2]]
+            for found in pool.map(self._branch, branches):
+                self.peaks.update(found)
+        finally:
+            pool.close()
+            pool.join()
+
+        table = [{'binsize': b, 'deg': d, 'delta': e,
+            'number of particles': len(self.peaks[(b, d, e)].T)}
+            for b, d, e in product(binsizes, degs, deltas)]
+        if self.validate:
+            for row in table:
+                scores = self.scores[(row['binsize'], row['deg'], row['delta'])]
+                row.update((k, scores[k]) for k in SCORES)
+        return table
+
+    def particles(self, binsize, deg, delta):
+        """ the peak table (like process_raw_data's r['particles']) of a
+            combination that was run already.
+            """
+        return self.peaks[(binsize, deg, delta)]
+
+    def _stage(self, task):
+        stage, key = task
+        if stage == 'smoothed':
+            return moving_average(self.parsed['Voltage_1'], n=key,
+                mode=self.smoothing)
+        return polyfit(self.parsed['X_Value'], self.parsed['Voltage_1'], d=key,
+            segment=self.segment)
+
+    def _branch(self, task):
+        binsize, deg, deltas = task
+        detrended = self.smoothed[binsize] - self.fits[deg]
+        found = {}
+        for delta in deltas:
+            mx, mn = find_peaks(self.parsed['X_Value'], detrended, delta=delta)
+            found[(binsize, deg, delta)] = mx if self.maxima else mn
+            if self.validate:
+                particles = found[(binsize, deg, delta)]
+                tolerance = self.tolerance if self.tolerance is not None \
+                    else binsize * self.parsed['delta_x']
+                self.scores[(binsize, deg, delta)] = match(particles[0] 
+                    if len(particles) else [], self.events[0], 
+                    self.events[1], tolerance)
+        return found
+
+
+def sweep(filename, binsizes=(20,), degs=(3,), deltas=(.004,), **kwargs):
+    """ runs a Sweep over the grid of binsizes x degs x deltas.
+        kwargs go to Sweep (maxima, smoothing, segment, workers, parse args).
+        returns the table, see Sweep.run
+        """
+    return Sweep(filename, **kwargs).run(binsizes, degs, deltas)
+
+
+def write_table(rows, path):
+    """ writes the table to path, .csv or .json/.jsonl (json lines) """
+    with open(path, 'w') as out:
+        if path.lower().endswith(('.json', '.jsonl')):
+            for row in rows:
+                out.write(json.dumps(row) + '\n')
+        else:
+            writer = csv.DictWriter(out, FIELDS + 
+                [k for k in SCORES if rows and k in rows[0]])
+            writer.writeheader()
+            writer.writerows(rows)
+
+
+def main(argv=None):
+    """ the command line entry point. returns the exit status """
+    parser = argparse.ArgumentParser(prog='anemia_plotter sweep',
+        description='particle counts over a grid of settings')
+    parser.add_argument('filename', help='the lvm file')
+    parser.add_argument('--binsize', type=int, nargs='+', default=[20])
+    parser.add_argument('--deg', type=int, nargs='+', default=[3])
+    parser.add_argument('--delta', type=float, nargs='+', default=[.004])
+    parser.add_argument('--smoothing', default='binned',
+        choices=['binned', 'centered', 'trailing'])
+    parser.add_argument('--segment', type=float, default=None,
+        help='seconds per drift fit segment, see calc.SegmentedFit')
+    parser.add_argument('--maxima', action='store_true',
+        help='count maxima instead of minima')
+    parser.add_argument('--validate', action='store_true',
+        help='score the peaks against the manual particle detector')
+    parser.add_argument('--tolerance', type=float, default=None,
+        help='seconds, see --validate. defaults to a bin of the smoothing')
+    parser.add_argument('-j', '--workers', type=int, default=None,
+        help='threads. defaults to the number of cpus')
+    parser.add_argument('-o', '--table', default=None,
+        help='write the table to this .csv or .json file')
+    args = parser.parse_args(argv)
+
+    rows = sweep(args.filename, args.binsize, args.deg, args.delta,
+        maxima=args.maxima or None, smoothing=args.smoothing,
+        segment=args.segment, workers=args.workers, validate=args.validate,
+        tolerance=args.tolerance, output=False)
+    if args.table:
+        write_table(rows, args.table)
+    scored = '{:>8}{:>8}{:>8}'.format('hits', 'misses', 'false') \
+        if args.validate else ''
+    print('{:>8}{:>6}{:>10}{:>12}'.format('binsize', 'deg', 'delta',
+        'particles') + scored)
+    for row in rows:
+        scored = '{hits:>8}{misses:>8}{false positives:>8}'.format(**row) \
+            if args.validate else ''
+        print('{binsize:>8}{deg:>6}{delta:>10}{number of particles:>12}'.format(
+            **row) + scored)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,105 @@
+'''
+    Checking the peaks found against the manual particle detector.
+
+    Whoever runs acquisition.vi presses the manual particle detector button
+    while a particle goes through. parse gives it as the
+    manual_particle_detector column: 1 while it's down, 0 (or nan before
+    the first comment) otherwise. Every run of 1s is an event, from the
+    first to the last sample it's down for.
+
+    The peaks (times) are matched against the events:
+        hits            events with a peak in them
+        misses          events without one
+        false positives peaks that aren't in any event
+        offsets         for every hit, the time from the start of the event
+                        to its first peak
+    Presses are never exactly on time, so the events are widened by a
+    tolerance (seconds) on both sides.
+
+    Both the events and the peaks are sorted by time, so all of it is two
+    binary searches (numpy.searchsorted), one over the peaks for every
+    event and one over the events for every peak. Hundreds of thousands of
+    peaks take milliseconds.
+'''
+from numpy import asarray, flatnonzero, concatenate, searchsorted, sort, \
+    diff, empty, clip, median, nan
+
+DETECTOR = 'manual_particle_detector'
+# the scalars of match, in the order they're reported
+SCORES = ['events', 'hits', 'misses', 'false positives', 'mean offset']
+
+
+def manual_events(x, flag):
+    """ the events of the manual particle detector.
+        args    -> x: times of the samples
+                -> flag: the manual_particle_detector column
+        returns starts, ends: the times of the first & last sample of
+            every event
+        """
+    x = asarray(x)
+    down = asarray(flag) > .5 # nan is never down
+    if not len(down):
+        return empty(0), empty(0)
+    changes = flatnonzero(diff(down.view('i1'))) + 1
+    edges = concatenate(([0], changes, [len(down)]))
+    # runs alternate between up & down, starting with whatever down[0] is
+    first = 0 if down[0] else 1
+    starts, stops = edges[first:-1:2], edges[first + 1::2]
+    return x[starts], x[stops - 1]
+
+
+def match(peaks, starts, ends, tolerance=0.):
+    """ matches peak times against events.
+
+        args    -> peaks: times of the peaks (r['particles'][0])
+                -> starts, ends: of the events, see manual_events
+                -> tolerance: seconds the events are widened by, both sides
+        returns a dict with the SCORES, and
+            offsets: start of the event to its first peak, for every hit
+            missed: the start of every event that was missed
+            false: the times of the false positives
+        """
+    peaks = sort(asarray(peaks, dtype=float))
+    starts, ends = asarray(starts, dtype=float), asarray(ends, dtype=float)
+    lo, hi = starts - tolerance, ends + tolerance
+
+    # the first peak at or after the start of every event. a hit if it's
+    # in the event
+    first = searchsorted(peaks, lo, 'left')
+    found = peaks[clip(first, 0, len(peaks) - 1)] if len(peaks) else lo
+    hit = (first < len(peaks)) & (found <= hi)
+    # the last event starting at or before every peak. a false positive if
+    # it's over by then
+    event = searchsorted(lo, peaks, 'right') - 1
+    inside = (event >= 0) & (peaks <= hi[clip(event, 0, None)]) \
+        if len(starts) else event >= 0
+
+    offsets = found[hit] - starts[hit]
+    return {
+        'events': len(starts),
+        'hits': int(hit.sum()),
+        'misses': int(len(starts) - hit.sum()),
+        'false positives': int(len(peaks) - inside.sum()),
+        'mean offset': offsets.mean() if len(offsets) else nan,
+        'median offset': median(offsets) if len(offsets) else nan,
+        'tolerance': tolerance,
+        'offsets': offsets,
+        'missed': starts[~hit],
+        'false': peaks[~inside],
+    }
+
+
+def validate(r, tolerance=None):
+    """ matches the particles of a process_raw_data result against its
+        manual particle detector, see match.
+        tolerance defaults to a bin of the smoothing (bin size * delta_x).
+        """
+    if DETECTOR not in r:
+        raise ValueError('{} has no {} column to check the peaks against'
+            .format(r['filename'], DETECTOR))
+    if tolerance is None:
+        tolerance = r['bin size'] * r['delta_x']
+    starts, ends = manual_events(r['X_Value'], r[DETECTOR])
+    particles = r['particles']
+    return match(particles[0] if len(particles) else [], starts, ends,
+        tolerance)